@@ -0,0 +1,104 @@
+"""
+Micro-benchmark of parsing the SA tags of a bam file, as done by purge2d.
+
+Times the reference length of every CIGAR in the SA tags with the uncached and cached
+surpyvor.purge2d.reference_length, and with the cigar package if it is installed,
+as well as the accidental 2D read test over all alignments.
+Without a bam file, a synthetic one is generated.
+
+Example:
+    python benchmarks/cigar_benchmark.py --bam long_reads.bam
+"""
+
+import json
+import os
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import synthetic  # noqa: E402
+
+
+def sa_cigars(bamfile, limit=None):
+    """Return the CIGAR strings of all SA tag entries of supplementary alignments"""
+    import pysam
+
+    cigars = []
+    with pysam.AlignmentFile(bamfile, "rb") as bam:
+        for read in bam.fetch(until_eof=True):
+            if read.is_supplementary and read.has_tag("SA"):
+                cigars.extend(s.split(",")[3] for s in read.get_tag("SA").split(";") if s)
+                if limit and len(cigars) >= limit:
+                    break
+    return cigars
+
+
+def timed(function, cigars, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for cigar in cigars:
+            function(cigar)
+        timings.append(time.perf_counter() - start)
+    return {"seconds": min(timings), "ns_per_cigar": round(1e9 * min(timings) / len(cigars), 1)}
+
+
+def time_accidental_2d(bamfile, repeat):
+    import pysam
+    from surpyvor.purge2d import is_accidental_2d
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with pysam.AlignmentFile(bamfile, "rb") as bam:
+            for read in bam.fetch(until_eof=True):
+                is_accidental_2d(read)
+        timings.append(time.perf_counter() - start)
+    return {"seconds": min(timings)}
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark parsing SA tag CIGAR strings.")
+    parser.add_argument("--bam", help="bam file to use instead of synthetic reads")
+    parser.add_argument("--reads", type=int, default=50000, help="number of synthetic reads")
+    parser.add_argument("--limit", type=int, help="maximal number of CIGAR strings to time")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per benchmark")
+    parser.add_argument("-o", "--output", help="json file to write results to", default="-")
+    args = parser.parse_args()
+
+    from surpyvor.purge2d import reference_length
+
+    with tempfile.TemporaryDirectory() as directory:
+        bamfile = args.bam or synthetic.write_bam(
+            os.path.join(directory, "reads.bam"), args.reads
+        )
+        cigars = sa_cigars(bamfile, limit=args.limit)
+        if not cigars:
+            sys.exit("ERROR: no supplementary alignments with an SA tag found.")
+        results = {
+            "cigars": len(cigars),
+            "unique_cigars": len(set(cigars)),
+            "reference_length": timed(reference_length.__wrapped__, cigars, args.repeat),
+            "reference_length_cached": timed(reference_length, cigars, args.repeat),
+        }
+        try:
+            from cigar import Cigar
+
+            results["cigar_package"] = timed(
+                lambda c: Cigar(c).reference_length(), cigars, args.repeat
+            )
+        except ImportError:
+            results["cigar_package"] = {"skipped": "cigar is not installed"}
+        results["is_accidental_2d"] = time_accidental_2d(bamfile, args.repeat)
+    if args.output == "-":
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as out:
+            json.dump(results, out, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+"""
+Time and memory-profile surpyvor stages on synthetic data, writing the results as JSON.
+
+Every benchmark runs in a fresh process, so that the peak RSS (maximum resident set size)
+reported is that of the benchmark alone. Benchmarks depending on an executable which isn't
+in $PATH (SURVIVOR, bcftools) are reported as skipped.
+
+Example:
+    python benchmarks/run_benchmarks.py --records 100000 --output results.json
+"""
+
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from functools import partial
+from shutil import which
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import synthetic  # noqa: E402
+
+
+def bench_merge(data, engine):
+    from surpyvor.surpyvor import sv_merge
+
+    sv_merge(
+        samples=data["vcfs"],
+        distance=500,
+        callers=1,
+        require_type=True,
+        require_strand=False,
+        estimate_distance=False,
+        minlength=50,
+        output=os.path.join(data["dir"], f"merged_{engine}.vcf"),
+        engine=engine,
+    )
+
+
+def bench_vcf_concat(data):
+    from surpyvor import utils
+
+    utils.vcf_concat(data["vcfs"])
+
+
+def bench_vcf_sort(data, shuffled=True):
+    from surpyvor import utils
+
+    utils.vcf_sort(
+        data["shuffled"] if shuffled else data["multisample"],
+        output=os.path.join(data["dir"], "sorted.vcf"),
+        max_records=data["records"] // 4,
+    )
+
+
+def bench_filter_vcf(data):
+    from surpyvor import utils
+
+    utils.filter_vcf(
+        data["multisample"], output=os.path.join(data["dir"], "filtered.vcf"), minlength=100
+    )
+
+
+def bench_fix_vcf(data):
+    from surpyvor import utils
+
+    utils.fix_vcf(
+        data["multisample"], output=os.path.join(data["dir"], "fixed.vcf"), fai=data["fai"]
+    )
+
+
+def bench_get_svlengths(data):
+    from surpyvor import utils
+
+    utils.get_svlengths(data["multisample"], all=True)
+
+
+def bench_purge2d(data, threads=1):
+    from surpyvor import purge2d
+
+    purge2d.process(data["bam"], output=os.path.join(data["dir"], "purged.bam"), threads=threads)
+
+
+# name: (function, required executables, what the throughput is counted in)
+BENCHMARKS = {
+    "sv_merge_survivor": (partial(bench_merge, engine="survivor"), ["SURVIVOR"], "records"),
+    "sv_merge_native": (partial(bench_merge, engine="native"), [], "records"),
+    "vcf_concat": (bench_vcf_concat, [], "records"),
+    "vcf_sort": (bench_vcf_sort, [], "records"),
+    "vcf_sort_sorted": (partial(bench_vcf_sort, shuffled=False), [], "records"),
+    "filter_vcf": (bench_filter_vcf, [], "records"),
+    "fix_vcf": (bench_fix_vcf, [], "records"),
+    "get_svlengths": (bench_get_svlengths, [], "records"),
+    "purge2d": (bench_purge2d, [], "alignments"),
+    "purge2d_threads": (partial(bench_purge2d, threads=4), [], "alignments"),
+}
+
+
+def measure(function, data, queue):
+    devnull = open(os.devnull, "w")
+    sys.stdout, sys.stderr = devnull, devnull
+    start = time.perf_counter()
+    function(data)
+    seconds = time.perf_counter() - start
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    queue.put((seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale))
+
+
+def run(name, data, repeat=1):
+    function, executables, unit = BENCHMARKS[name]
+    missing = [e for e in executables if not which(e)]
+    if missing:
+        return {"name": name, "skipped": f"missing {', '.join(missing)}"}
+    timings, peaks = [], []
+    for _ in range(repeat):
+        queue = multiprocessing.Queue()
+        p = multiprocessing.Process(target=measure, args=(function, data, queue))
+        p.start()
+        p.join()
+        if p.exitcode != 0:
+            return {"name": name, "error": f"exit code {p.exitcode}"}
+        seconds, peak = queue.get()
+        timings.append(seconds)
+        peaks.append(peak)
+    return {
+        "name": name,
+        "seconds": min(timings),
+        "timings": timings,
+        "peak_rss_mb": round(max(peaks) / 1e6, 2),
+        f"{unit}_per_second": round(data[unit] / min(timings), 1),
+    }
+
+
+def make_data(args, directory):
+    svs = synthetic.draw_svs(args.records, synthetic.parse_svtypes(args.svtypes), seed=args.seed)
+    vcfs = [
+        synthetic.write_vcf(
+            os.path.join(directory, f"caller{i}.vcf"),
+            svs,
+            jitter=args.jitter,
+            fraction=0.8,
+            seed=args.seed + i + 1,
+            name=f"caller{i}",
+        )
+        for i in range(args.files)
+    ]
+    multisample = synthetic.write_vcf(
+        os.path.join(directory, "cohort.vcf"), svs, samples=args.samples, seed=args.seed
+    )
+    bam = synthetic.write_bam(os.path.join(directory, "reads.bam"), args.reads, seed=args.seed)
+    return {
+        "dir": directory,
+        "records": args.records,
+        "vcfs": vcfs,
+        "multisample": multisample,
+        "shuffled": synthetic.shuffle_vcf(
+            multisample, os.path.join(directory, "shuffled.vcf"), seed=args.seed
+        ),
+        "fai": synthetic.write_fai(os.path.join(directory, "genome.fa.fai")),
+        "bam": bam,
+        "alignments": count_alignments(bam),
+    }
+
+
+def count_alignments(bam):
+    """Return the number of alignments (primary and supplementary) in an indexed bam file"""
+    import pysam
+
+    with pysam.AlignmentFile(bam) as alignments:
+        return alignments.mapped + alignments.unmapped
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark surpyvor stages on synthetic data.")
+    parser.add_argument("--records", type=int, default=20000, help="number of SVs per vcf")
+    parser.add_argument("--samples", type=int, default=10, help="samples in the cohort vcf")
+    parser.add_argument("--files", type=int, default=3, help="number of vcf files to merge")
+    parser.add_argument("--svtypes", default="DEL:0.45,INS:0.35,DUP:0.1,INV:0.1")
+    parser.add_argument("--jitter", type=int, default=100, help="maximal breakpoint jitter")
+    parser.add_argument("--reads", type=int, default=20000, help="number of reads in the bam")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per benchmark")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--benchmarks", nargs="*", choices=list(BENCHMARKS), default=list(BENCHMARKS)
+    )
+    parser.add_argument("-o", "--output", help="json file to write results to", default="-")
+    args = parser.parse_args()
+
+    from surpyvor.version import __version__
+
+    with tempfile.TemporaryDirectory() as directory:
+        data = make_data(args, directory)
+        results = [run(name, data, repeat=args.repeat) for name in args.benchmarks]
+    report = {
+        "surpyvor": __version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "parameters": {k: v for k, v in vars(args).items() if k not in ["output", "benchmarks"]},
+        "results": results,
+    }
+    if args.output == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as out:
+            json.dump(report, out, indent=2)
+
+
+if __name__ == "__main__":
+    main()
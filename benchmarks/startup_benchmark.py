@@ -0,0 +1,73 @@
+"""
+Benchmark of the startup time of the surpyvor command line interface.
+
+Times importing the surpyvor modules and running short sub-commands in a fresh interpreter,
+as done by wrapper scripts calling surpyvor once per file, compared to an empty interpreter.
+The sub-commands run on a small synthetic vcf file.
+
+Example:
+    python benchmarks/startup_benchmark.py --repeat 10
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import synthetic  # noqa: E402
+
+MODULES = ["surpyvor.surpyvor", "surpyvor.utils", "surpyvor.plots", "surpyvor.purge2d"]
+
+
+def timed(argv, repeat):
+    """Return the fastest wall clock time of running argv in a subprocess"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(argv, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    return {"seconds": round(min(timings), 4)}
+
+
+def commands(directory, records):
+    vcf = synthetic.write_vcf(
+        os.path.join(directory, "calls.vcf"), synthetic.draw_svs(records, {"DEL": 1, "INS": 1})
+    )
+    out = os.path.join(directory, "out")
+    return {
+        "help": ["--help"],
+        "lengthplot": ["lengthplot", vcf, "--plotout", out + ".png", "--counts", out + ".txt"],
+        "minlen": ["minlen", vcf, "-l", "100", "-o", out + ".vcf"],
+        "purge2d_help": ["purge2d", "--help"],
+    }
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark the startup time of surpyvor.")
+    parser.add_argument("--records", type=int, default=100, help="number of SVs in the vcf")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per benchmark")
+    parser.add_argument("-o", "--output", help="json file to write results to", default="-")
+    args = parser.parse_args()
+
+    results = {"python": timed([sys.executable, "-c", "pass"], args.repeat)}
+    for module in MODULES:
+        results[f"import {module}"] = timed([sys.executable, "-c", f"import {module}"], args.repeat)
+    with tempfile.TemporaryDirectory() as directory:
+        for name, argv in commands(directory, args.records).items():
+            results[f"surpyvor {name}"] = timed(
+                [sys.executable, "-m", "surpyvor.surpyvor"] + argv, args.repeat
+            )
+    if args.output == "-":
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as out:
+            json.dump(results, out, indent=2)
+
+
+if __name__ == "__main__":
+    main()
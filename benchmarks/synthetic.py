@@ -0,0 +1,169 @@
+"""
+Deterministic generator of synthetic SV vcf files and bam files for benchmarking.
+
+A set of "true" SVs is drawn once, and every generated vcf file reports these with a random
+subset of calls and breakpoints jittered by up to <jitter> bp, mimicking different callers
+on the same sample. Bam files contain long reads of which a fraction has a supplementary
+alignment on the opposite strand overlapping the primary alignment (accidental 2D reads).
+All output only depends on the seed and the parameters.
+"""
+
+import random
+from argparse import ArgumentParser
+
+CONTIGS = {"chr1": 50_000_000, "chr2": 40_000_000, "chr3": 30_000_000}
+GENOTYPES = ["0/1", "0/1", "1/1", "0/0", "./."]
+
+
+def parse_svtypes(spec):
+    """Parse a string like DEL:0.5,INS:0.3,DUP:0.1,INV:0.1 to a dict of type: weight"""
+    return {t: float(w) for t, w in (item.split(":") for item in spec.split(","))}
+
+
+def draw_svs(records, svtypes, seed=0):
+    """Return a sorted list of (chrom, pos, svtype, svlen) tuples"""
+    rng = random.Random(seed)
+    names = list(CONTIGS)
+    weights = [CONTIGS[c] for c in names]
+    types, type_weights = zip(*svtypes.items())
+    svs = []
+    for _ in range(records):
+        chrom = rng.choices(names, weights=weights)[0]
+        svlen = int(rng.lognormvariate(6, 1.2)) + 50
+        pos = rng.randint(1, CONTIGS[chrom] - svlen - 1)
+        svs.append((chrom, pos, rng.choices(types, weights=type_weights)[0], svlen))
+    return sorted(svs, key=lambda sv: (names.index(sv[0]), sv[1]))
+
+
+def vcf_header(samples):
+    header = ["##fileformat=VCFv4.2", "##source=surpyvor-benchmark"]
+    header.extend(f"##contig=<ID={c},length={length}>" for c, length in CONTIGS.items())
+    header.extend(
+        [
+            '##INFO=<ID=SVTYPE,Number=1,Type=String,Description="Type of the SV">',
+            '##INFO=<ID=SVLEN,Number=1,Type=Integer,Description="Length of the SV">',
+            '##INFO=<ID=END,Number=1,Type=Integer,Description="End of the SV">',
+            '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">',
+            "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t" + "\t".join(samples),
+        ]
+    )
+    return "\n".join(header) + "\n"
+
+
+def write_vcf(output, svs, samples=1, jitter=0, fraction=1.0, seed=0, name="caller"):
+    """Write a sorted vcf with a random <fraction> of svs, breakpoints jittered by <jitter> bp"""
+    rng = random.Random(seed)
+    names = list(CONTIGS)
+    records = []
+    for index, (chrom, pos, svtype, svlen) in enumerate(svs):
+        if rng.random() > fraction:
+            continue
+        pos = max(1, pos + rng.randint(-jitter, jitter))
+        end = pos + 1 if svtype == "INS" else pos + svlen
+        info = f"SVTYPE={svtype};SVLEN={-svlen if svtype == 'DEL' else svlen};END={end}"
+        gts = "\t".join(rng.choice(GENOTYPES) for _ in range(samples))
+        line = f"{chrom}\t{pos}\t{name}_{index}\tN\t<{svtype}>\t.\tPASS\t{info}\tGT\t{gts}\n"
+        records.append((names.index(chrom), pos, line))
+    records.sort(key=lambda r: (r[0], r[1]))
+    with open(output, "w") as out:
+        out.write(vcf_header([f"{name}_{i}" for i in range(samples)] if samples > 1 else [name]))
+        out.writelines(r[2] for r in records)
+    return output
+
+
+def shuffle_vcf(vcf, output, seed=0):
+    """Write the records of vcf in random order, keeping the header"""
+    rng = random.Random(seed)
+    with open(vcf) as lines:
+        header, records = [], []
+        for line in lines:
+            (header if line.startswith("#") else records).append(line)
+    rng.shuffle(records)
+    with open(output, "w") as out:
+        out.writelines(header + records)
+    return output
+
+
+def write_fai(output):
+    with open(output, "w") as out:
+        for chrom, length in CONTIGS.items():
+            out.write(f"{chrom}\t{length}\t0\t60\t61\n")
+    return output
+
+
+def write_bam(output, reads, artefacts=0.05, read_length=8000, seed=0):
+    """Write a sorted and indexed bam file of long reads with supplementary alignments
+
+    A fraction <artefacts> of reads is an accidental 2D read: the supplementary alignment is on
+    the reverse strand, overlapping the primary alignment. The other reads with a supplementary
+    alignment have it on the same strand, elsewhere on the chromosome.
+    """
+    import pysam
+
+    rng = random.Random(seed)
+    names = list(CONTIGS)
+    header = {
+        "HD": {"VN": "1.6", "SO": "coordinate"},
+        "SQ": [{"SN": c, "LN": length} for c, length in CONTIGS.items()],
+    }
+    half = read_length // 2
+    alignments = []
+    for i in range(reads):
+        chrom = rng.choice(names)
+        pos = rng.randint(0, CONTIGS[chrom] - read_length * 2)
+        primary = (chrom, pos, "+", f"{half}M{half}S", False)
+        if rng.random() < artefacts:
+            supplementary = (chrom, pos + rng.randint(0, half // 2), "-", f"{half}S{half}M", True)
+        elif rng.random() < 0.3:
+            supp_pos = rng.randint(0, CONTIGS[chrom] - read_length)
+            supplementary = (chrom, supp_pos, "+", f"{half}S{half}M", True)
+        else:
+            alignments.append((f"read{i}", primary, None))
+            continue
+        alignments.append((f"read{i}", primary, supplementary))
+        alignments.append((f"read{i}", supplementary, primary))
+    alignments.sort(key=lambda a: (names.index(a[1][0]), a[1][1]))
+    with pysam.AlignmentFile(output, "wb", header=header) as bam:
+        for name, (chrom, pos, strand, cigar, supp), other in alignments:
+            a = pysam.AlignedSegment(bam.header)
+            a.query_name = name
+            a.reference_id = names.index(chrom)
+            a.reference_start = pos
+            a.cigarstring = cigar
+            a.mapping_quality = 60
+            a.flag = (16 if strand == "-" else 0) | (2048 if supp else 0)
+            if other:
+                a.set_tag("SA", f"{other[0]},{other[1] + 1},{other[2]},{other[3]},60,0;")
+            bam.write(a)
+    pysam.index(output)
+    return output
+
+
+def main():
+    parser = ArgumentParser(description="Generate synthetic SV vcf and bam files.")
+    parser.add_argument("--records", type=int, default=10000, help="number of SVs")
+    parser.add_argument("--samples", type=int, default=1, help="number of samples per vcf")
+    parser.add_argument("--files", type=int, default=3, help="number of vcf files (callers)")
+    parser.add_argument("--svtypes", default="DEL:0.45,INS:0.35,DUP:0.1,INV:0.1")
+    parser.add_argument("--jitter", type=int, default=100, help="maximal breakpoint jitter")
+    parser.add_argument("--reads", type=int, default=0, help="number of reads in a bam file")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--prefix", default="synthetic")
+    args = parser.parse_args()
+    svs = draw_svs(args.records, parse_svtypes(args.svtypes), seed=args.seed)
+    for i in range(args.files):
+        write_vcf(
+            f"{args.prefix}_{i}.vcf",
+            svs,
+            samples=args.samples,
+            jitter=args.jitter,
+            fraction=0.8,
+            seed=args.seed + i + 1,
+            name=f"caller{i}",
+        )
+    if args.reads:
+        write_bam(f"{args.prefix}.bam", args.reads, seed=args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -38,8 +38,6 @@ setup(
         "numpy",
         "UpSetPlot",
         "pysam",
-        "cigar",
-        "pyfaidx",
     ],
     package_data={"surpyvor": []},
     package_dir={"surpyvor": "surpyvor"},
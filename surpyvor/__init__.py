@@ -1,2 +0,0 @@
-import matplotlib
-matplotlib.use('Agg')
@@ -0,0 +1,132 @@
+"""
+Running a sub-command over a manifest of many samples in one long-lived interpreter.
+
+Every line of the manifest holds the (tab-separated) arguments of a surpyvor sub-command,
+which is parsed and run in a pool of worker processes. Imports, checking dependencies and
+building the argument parser happen once per worker rather than once per sample.
+A failing job is reported without stopping the other jobs.
+"""
+
+import sys
+import time
+import traceback
+from collections import namedtuple
+
+Job = namedtuple("Job", ["number", "argv"])
+Result = namedtuple("Result", ["job", "status", "seconds", "error"])
+
+
+def read_manifest(manifest, command=None):
+    """Return a Job per line of the manifest, skipping empty lines and lines starting with #
+
+    Empty fields are ignored, and with command every line gets this sub-command prepended.
+    """
+    jobs = []
+    with open(manifest) as lines:
+        for number, line in enumerate(lines, start=1):
+            if not line.strip() or line.startswith("#"):
+                continue
+            argv = [field for field in line.rstrip("\n").split("\t") if field]
+            if command:
+                argv.insert(0, command)
+            if argv[0] == "batch":
+                sys.exit(f"INPUT ERROR: line {number} of {manifest} can't run batch itself!")
+            jobs.append(Job(number, argv))
+    return jobs
+
+
+def run_jobs(jobs, processes=1, verbose=False):
+    """Run jobs in a pool of <processes> worker processes and return a Result per job
+
+    Results are reported on stderr as soon as they are ready.
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    from concurrent.futures.process import BrokenProcessPool
+
+    results = {}
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = {pool.submit(run_job, job): job for job in jobs}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except BrokenProcessPool as e:
+                result = Result(futures[future], "failed", 0.0, f"worker process died: {e}")
+            results[result.job.number] = result
+            report(result, verbose=verbose)
+    return [results[job.number] for job in jobs]
+
+
+def run_job(job):
+    """Parse and run the arguments of job, catching errors and exits"""
+    from surpyvor import utils
+    from surpyvor.surpyvor import required_executables, run
+
+    start = time.perf_counter()
+    try:
+        args = parse_args(job.argv)
+        utils.test_dependencies(required_executables(args))
+        with utils.scratch_space(args.tmpdir):
+            run(args)
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            return Result(job, "failed", time.perf_counter() - start, exit_message(e.code))
+    except Exception:
+        error = traceback.format_exc().strip().split("\n")[-1]
+        return Result(job, "failed", time.perf_counter() - start, error)
+    return Result(job, "ok", time.perf_counter() - start, "")
+
+
+def parse_args(argv):
+    """Parse argv, exiting with just the error message rather than the usage on stderr"""
+    import io
+    from contextlib import redirect_stderr
+    from surpyvor import parse_arguments
+
+    messages = io.StringIO()
+    try:
+        with redirect_stderr(messages):
+            return parse_arguments.get_args(argv)
+    except SystemExit as e:
+        lines = messages.getvalue().strip().split("\n")
+        sys.exit(lines[-1] if e.code == 2 else e.code)
+
+
+def exit_message(code):
+    if isinstance(code, int):
+        return f"exited with code {code}"
+    return str(code).strip().replace("\n", " ")
+
+
+def report(result, verbose=False):
+    if result.status == "ok":
+        if verbose:
+            sys.stderr.write(f"Line {result.job.number}: done in {result.seconds:.2f}s\n")
+    else:
+        sys.stderr.write(
+            f"Line {result.job.number}: {' '.join(result.job.argv)} "
+            f"failed after {result.seconds:.2f}s: {result.error}\n"
+        )
+
+
+def write_report(results, output):
+    with open(output, "w") as out:
+        out.write("line\tstatus\tseconds\targuments\terror\n")
+        for r in results:
+            out.write(
+                f"{r.job.number}\t{r.status}\t{r.seconds:.3f}\t{' '.join(r.job.argv)}\t{r.error}\n"
+            )
+
+
+def batch(manifest, jobs=1, command=None, report_file=None, verbose=False):
+    """Run all lines of manifest and exit with an error if any of them failed"""
+    to_run = read_manifest(manifest, command=command)
+    start = time.perf_counter()
+    results = run_jobs(to_run, processes=jobs, verbose=verbose)
+    if report_file:
+        write_report(results, report_file)
+    failed = [r for r in results if r.status != "ok"]
+    sys.stderr.write(
+        f"Ran {len(results)} jobs in {time.perf_counter() - start:.2f}s, {len(failed)} failed.\n"
+    )
+    if failed:
+        sys.exit(1)
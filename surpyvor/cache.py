@@ -0,0 +1,74 @@
+"""
+On-disk cache of merged vcf files.
+
+Merged vcf files are stored under a key derived from the path, modification time and size of
+the input files and the merge parameters, so that repeated comparisons of the same files skip
+the merge entirely. The least recently used files are evicted once the cache exceeds its
+maximal size.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+
+def default_cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "surpyvor")
+
+
+def merge_key(vcffiles, **params):
+    """Return a hash of the identity of the input files and the merge parameters"""
+    files = []
+    for vcffile in vcffiles:
+        stat = os.stat(vcffile)
+        files.append([os.path.abspath(vcffile), stat.st_mtime_ns, stat.st_size])
+    identity = json.dumps({"files": files, "params": params}, sort_keys=True)
+    return hashlib.sha1(identity.encode()).hexdigest()
+
+
+def lookup(key, directory):
+    """Return the path of the cached vcf for key, or None if absent"""
+    path = os.path.join(directory, key + ".vcf")
+    if os.path.isfile(path):
+        # mark as recently used in the access time, the modification time identifies the file
+        os.utime(path, ns=(time.time_ns(), os.stat(path).st_mtime_ns))
+        return path
+    return None
+
+
+def store(key, vcf, directory, max_size):
+    """Copy vcf to the cache and evict the least recently used files above max_size bytes"""
+    os.makedirs(directory, exist_ok=True)
+    handle, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    os.close(handle)
+    shutil.copyfile(vcf, tmp)
+    path = os.path.join(directory, key + ".vcf")
+    os.replace(tmp, path)
+    evict(directory, max_size)
+    return path
+
+
+def evict(directory, max_size):
+    """Remove the least recently used vcf files, and their sidecar files, above max_size bytes"""
+    from surpyvor.sidecar import sidecar_path
+
+    entries = []
+    for name in os.listdir(directory):
+        if name.endswith(".vcf"):
+            path = os.path.join(directory, name)
+            size = os.stat(path).st_size
+            if os.path.isfile(sidecar_path(path)):
+                size += os.stat(sidecar_path(path)).st_size
+            entries.append((os.stat(path).st_atime, size, path))
+    total = sum(e[1] for e in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        os.remove(path)
+        if os.path.isfile(sidecar_path(path)):
+            os.remove(sidecar_path(path))
+        total -= size
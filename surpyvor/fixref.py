@@ -1,8 +1,8 @@
-from cyvcf2 import VCF, Writer
-from pyfaidx import Fasta
+import pysam
+from surpyvor import utils
 
 
-def fixref(vcf, fasta):
+def fixref(vcf, fasta, output="-", regions=None, samples=None, max_ref_len=None):
     """
     Fix reference alleles in VCF file.
 
@@ -12,10 +12,72 @@ def fixref(vcf, fasta):
         Path to VCF file.
     fasta : str
         Path to FASTA file.
+    output : str, optional
+        VCF file to write to, or "-" for stdout. Output ending in .gz is compressed and indexed.
+    regions : list, optional
+        (chrom, start, end) tuples to restrict to, see utils.get_regions.
+    samples : list, optional
+        Names of the samples to keep.
+    max_ref_len : int, optional
+        For SVs with a longer reference allele, only the first base is used as REF
+        and ALT becomes a symbolic allele of the SVTYPE, such as <DEL>.
     """
-    fas = Fasta(fasta)
-    vcf = VCF(vcf)
-    w = Writer("-", vcf)
-    for v in vcf:
-        v.REF = fas[v.CHROM][v.start : v.end].seq
+    reference = ReferenceCache(fasta)
+    vcf = utils.open_vcf(vcf, regions=regions, samples=samples)
+    if max_ref_len is not None and "END" not in vcf:
+        vcf.add_info_to_header(
+            {
+                "ID": "END",
+                "Description": "End position of the variant",
+                "Type": "Integer",
+                "Number": "1",
+            }
+        )
+    w = utils.open_writer(output, vcf)
+    for v in utils.records(vcf, regions):
+        end = v.end
+        if max_ref_len is not None and end - v.start > max_ref_len and symbolic_alt(v):
+            v.ALT = [symbolic_alt(v)]
+            v.REF = reference.fetch(v.CHROM, v.start, v.start + 1)
+            if v.INFO.get("END") is None:
+                v.INFO["END"] = end
+        else:
+            v.REF = reference.fetch(v.CHROM, v.start, end)
         w.write_record(v)
+    w.close()
+    utils.index_vcf(output)
+
+
+def symbolic_alt(v):
+    """Return the symbolic ALT allele of an SV, from ALT or INFO/SVTYPE, or None if unknown"""
+    if v.ALT and v.ALT[0].startswith("<"):
+        return v.ALT[0]
+    svtype = v.INFO.get("SVTYPE")
+    return "<{}>".format(svtype) if svtype else None
+
+
+class ReferenceCache(object):
+    """
+    Reference sequence access through pysam.FastaFile, reading blocks of <block_size> bases.
+
+    Only the current block is kept, so lookups should be grouped by contig and sorted by position,
+    as they are when iterating over the records of a sorted vcf. Sequences longer than a block
+    are read in one go.
+    """
+
+    def __init__(self, fasta, block_size=1000000):
+        self.fasta = pysam.FastaFile(fasta)
+        self.lengths = dict(zip(self.fasta.references, self.fasta.lengths))
+        self.block_size = block_size
+        self.chrom = None
+        self.start = self.end = 0
+        self.block = ""
+
+    def fetch(self, chrom, start, end):
+        """Return the sequence of chrom from 0-based start up to end"""
+        end = min(end, self.lengths[chrom])
+        if chrom != self.chrom or start < self.start or end > self.end:
+            block_end = min(max(end, start + self.block_size), self.lengths[chrom])
+            self.block = self.fasta.fetch(chrom, start, block_end)
+            self.chrom, self.start, self.end = chrom, start, block_end
+        return self.block[start - self.start : end - self.start]
@@ -1,40 +1,135 @@
-import tempfile
-from cyvcf2 import VCF
 from surpyvor import utils
+import os
 import sys
 
+GT_TYPES = {'0/0': 0, '0/1': 1, './.': 2, '1/1': 3}
+ALLELES = {0: 'HOM_REF', 1: 'HET', 2: 'UNKNOWN', 3: 'HOM_ALT'}
+
 
 def merge_split_called_haplotypes(merged, output, name=None):
-    _, name = tempfile.mkstemp(suffix='.vcf')
-    vcf = VCF(merged)
-    if len(vcf.samples) == 3:
-        get_genotype = get_genotype_from_three
-    elif len(vcf.samples) == 2:
-        get_genotype = get_genotype_from_two
+    '''Combine the samples of a sorted vcf merged by SURVIVOR to one phased sample'''
+    vcf = utils.open_vcf(merged)
+    get_genotype = genotype_function(len(vcf.samples))
+    contigs = {line['ID']: None for line in vcf.header_iter() if line["HeaderType"] == 'CONTIG'}
+    with utils.open_output(output) as out:
+        out.write("{}\n".format('\n'.join(make_header(contigs, name=name))))
+        for v in vcf:
+            out.write(format_record(chrom=v.CHROM,
+                                    pos=v.POS,
+                                    idf=v.ID,
+                                    ref=v.REF,
+                                    alt=','.join(v.ALT),
+                                    qual=v.QUAL,
+                                    svlen=v.INFO.get('SVLEN'),
+                                    end=v.end,
+                                    svtype=v.INFO.get('SVTYPE'),
+                                    alleles=v.gt_types,
+                                    get_genotype=get_genotype))
+
+
+def merge_haplotypes(vcffiles, output, name=None, distance=200, minlength=50, require_type=True,
+                     require_strand=False, estimate_distance=False, svtype_map=None):
+    '''Merge the calls on two haplotypes (and optionally an unphased set) to one phased sample
+
+    The coordinate-sorted vcf files are streamed with a k-way merge and calls are clustered
+    with the native merge engine, so records are written in sorted order without SURVIVOR.
+    '''
+    from surpyvor.nativemerge import cluster_calls, is_long_enough, parse_call
+
+    get_genotype = genotype_function(len(vcffiles))
+    contigs = utils.get_contigs(vcffiles)
+    rank = {c: i for i, c in enumerate(contigs)}
+    calls = (parse_call(v, sample=index, svtype_map=svtype_map)
+             for index, v in utils.merge_sorted_vcfs(vcffiles, rank=rank, source=True))
+    clusters = cluster_calls((c for c in calls if is_long_enough(c, minlength)),
+                             distance=distance,
+                             require_type=require_type,
+                             require_strand=require_strand,
+                             estimate_distance=estimate_distance)
+    with utils.open_output(output) as out:
+        out.write("{}\n".format('\n'.join(make_header(contigs, name=name))))
+        for cluster in clusters:
+            rep = cluster[0]
+            alleles = [GT_TYPES['./.']] * len(vcffiles)
+            for call in reversed(cluster):  # the first call of a haplotype takes precedence
+                alleles[call.sample] = GT_TYPES.get(call.gt, GT_TYPES['./.'])
+            out.write(format_record(chrom=rep.chrom,
+                                    pos=rep.start + 1,
+                                    idf=rep.id,
+                                    ref=rep.ref,
+                                    alt=rep.alt,
+                                    qual=None,
+                                    svlen=rep.svlen,
+                                    end=rep.end,
+                                    svtype=rep.svtype,
+                                    alleles=alleles,
+                                    get_genotype=get_genotype))
+
+
+def merge_samples(samples, outdir, threads=1, **merge_kwargs):
+    '''Run merge_haplotypes for every (name, vcffiles) in samples, using <threads> processes
+
+    Every sample is written to <outdir>/<name>.vcf.gz, returned is the list of output files.
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+
+    os.makedirs(outdir, exist_ok=True)
+    outputs = [os.path.join(outdir, '{}.vcf.gz'.format(name)) for name, _ in samples]
+    with ProcessPoolExecutor(max_workers=threads) as pool:
+        jobs = [pool.submit(merge_haplotypes, vcffiles, output, name=name, **merge_kwargs)
+                for (name, vcffiles), output in zip(samples, outputs)]
+        for job in jobs:
+            job.result()
+    return outputs
+
+
+def read_samples_file(samples_file):
+    '''Parse a tab-separated file with per line a sample name, hap1, hap2 and optionally
+    unphased vcf file, returning a list of (name, vcffiles) tuples'''
+    samples = []
+    with open(samples_file) as lines:
+        for number, line in enumerate(lines, start=1):
+            if not line.strip() or line.startswith('#'):
+                continue
+            name, *vcffiles = line.rstrip('\n').split('\t')
+            if len(vcffiles) not in [2, 3]:
+                sys.exit("INPUT ERROR: line {} of {} should have a sample name and 2 or 3 vcf "
+                         "files separated by tabs!".format(number, samples_file))
+            for f in vcffiles:
+                if not os.path.isfile(f):
+                    sys.exit(f"File not found: {f}")
+            samples.append((name, vcffiles))
+    if len({name for name, _ in samples}) < len(samples):
+        sys.exit("INPUT ERROR: sample names in {} should be unique!".format(samples_file))
+    return samples
+
+
+def genotype_function(num_haplotypes):
+    if num_haplotypes == 3:
+        return get_genotype_from_three
+    elif num_haplotypes == 2:
+        return get_genotype_from_two
     else:
         sys.exit("ERROR: Unexpected number of samples in haplomerge intermediate VCF!")
-    with open(name, 'a') as tmpoutput:
-        tmpoutput.write("{}\n".format('\n'.join(make_header(vcf, name=name))))
-        allele_dict = {0: 'HOM_REF', 1: 'HET', 2: 'UNKNOWN', 3: 'HOM_ALT'}
-        for v in vcf:
-            info = {'SVLEN': v.INFO.get('SVLEN'),
-                    'END': v.end,
-                    'SVTYPE': v.INFO.get('SVTYPE'),
-                    'HAPSUPPORT': '-'.join([allele_dict[gt] for gt in v.gt_types])}
-            print("{chrom}\t{pos}\t{idf}\t{ref}\t{alt}\t{q}\t{filt}\t{info}\t{form}\t{sam}"
-                  .format(
-                      chrom=v.CHROM,
-                      pos=v.start,
-                      idf=v.ID,
-                      ref=v.REF,
-                      alt=','.join(v.ALT),
-                      q=v.QUAL or '.',
-                      filt='.',
-                      info=';'.join(['{}={}'.format(k, v) for k, v in info.items()]),
-                      form='GT',
-                      sam=get_genotype(v.gt_types)),
-                  file=tmpoutput)
-    utils.vcf_sort(name, output)
+
+
+def format_record(chrom, pos, idf, ref, alt, qual, svlen, end, svtype, alleles, get_genotype):
+    '''Return a vcf line with phased GT and the genotype per haplotype in INFO/HAPSUPPORT'''
+    info = {'SVLEN': svlen,
+            'END': end,
+            'SVTYPE': svtype,
+            'HAPSUPPORT': '-'.join([ALLELES[gt] for gt in alleles])}
+    return "{chrom}\t{pos}\t{idf}\t{ref}\t{alt}\t{q}\t{filt}\t{info}\t{form}\t{sam}\n".format(
+        chrom=chrom,
+        pos=pos,
+        idf=idf or '.',
+        ref=ref,
+        alt=alt or '.',
+        q=qual or '.',
+        filt='.',
+        info=';'.join(['{}={}'.format(k, v) for k, v in info.items()]),
+        form='GT',
+        sam=get_genotype(alleles))
 
 
 def get_genotype_from_two(alleles):
@@ -54,11 +149,14 @@ def get_genotype_from_three(alleles):
         return '0|0'
 
 
-def make_header(vcf, name=None):
+def make_header(contigs, name=None):
+    '''Return the header lines, contigs is a dict of contig names and lengths (or None)'''
     header = ['##fileformat=VCFv4.1', '##source=surpyvor haplomerge']
-    for line in vcf.header_iter():
-        if line["HeaderType"] == 'CONTIG':
-            header.append('##contig=<ID={}>'.format(line['ID']))
+    for contig, length in contigs.items():
+        if length:
+            header.append('##contig=<ID={},length={}>'.format(contig, length))
+        else:
+            header.append('##contig=<ID={}>'.format(contig))
     if name is None:
         name = "SAMPLE"
     header.extend([
@@ -0,0 +1,318 @@
+"""
+In-process merging of SV vcf files, as an alternative to SURVIVOR merge.
+
+Calls are clustered per chromosome with a sorted sweep over breakpoints:
+two calls are concordant if both their start and end coordinates are within
+<distance> of each other and, when requested, they have the same type and strands.
+The merged vcf is written in sorted order, so no extra sorting step is needed.
+"""
+
+import re
+import sys
+from collections import deque, namedtuple
+from cyvcf2 import VCF
+from surpyvor import utils
+
+SVCall = namedtuple(
+    "SVCall",
+    [
+        "chrom",
+        "start",
+        "chr2",
+        "end",
+        "svtype",
+        "svlen",
+        "strands",
+        "sample",
+        "gt",
+        "id",
+        "ref",
+        "alt",
+    ],
+)
+
+GT_STRINGS = {0: "0/0", 1: "0/1", 2: "./.", 3: "1/1"}
+BND_MATE = re.compile(r"[\[\]]([^\[\]:]+):(\d+)[\[\]]")
+
+
+def merge_vcfs(
+    vcffiles,
+    output,
+    distance,
+    callers,
+    require_type,
+    require_strand,
+    estimate_distance,
+    minlength,
+    pool_samples=False,
+    svtype_map=None,
+    verbose=False,
+):
+    """Merge the SVs in vcffiles and write a sorted multi-sample vcf to output
+
+    With pool_samples all vcf files are treated as the same sample. The records of
+    the (coordinate-sorted) files are then streamed with a k-way merge,
+    rather than collected and sorted in memory.
+    SV types in svtype_map (e.g. utils.DUP_TO_INS) are renamed while parsing the records.
+    """
+    contigs = utils.get_contigs(vcffiles)
+    rank = {c: i for i, c in enumerate(contigs)}
+    if pool_samples:
+        calls = read_calls(
+            utils.merge_sorted_vcfs(vcffiles, rank=rank),
+            sample=0,
+            minlength=minlength,
+            svtype_map=svtype_map,
+        )
+        names = get_sample_names(vcffiles[:1])
+    else:
+        calls = []
+        for sample, vcffile in enumerate(vcffiles):
+            calls.extend(
+                read_calls(
+                    utils.open_vcf(vcffile),
+                    sample=sample,
+                    minlength=minlength,
+                    svtype_map=svtype_map,
+                )
+            )
+        calls.sort(key=lambda c: (rank.setdefault(c.chrom, len(rank)), c.start, c.end))
+        for contig in rank:
+            contigs.setdefault(contig, None)
+        names = get_sample_names(vcffiles)
+        if verbose:
+            sys.stderr.write(f"Clustering {len(calls)} calls from {len(vcffiles)} vcf files.\n")
+    clusters = cluster_calls(
+        calls,
+        distance=distance,
+        require_type=require_type,
+        require_strand=require_strand,
+        estimate_distance=estimate_distance,
+    )
+    write_merged(clusters, output=output, contigs=contigs, names=names, callers=callers)
+
+
+def get_sample_names(vcffiles):
+    """Return the first sample of every vcf, made unique if the same name is used twice"""
+    names = []
+    for vcffile in vcffiles:
+        vcf = VCF(vcffile)
+        name = vcf.samples[0]
+        vcf.close()
+        if name in names:
+            name = f"{name}_{len(names)}"
+        names.append(name)
+    return names
+
+
+def read_calls(variants, sample, minlength=0, svtype_map=None):
+    """Yield an SVCall for every SV of at least minlength in variants
+
+    Calls are kept on the chromosome of the record, also for interchromosomal events,
+    so that sorted input results in sorted calls.
+    """
+    for v in variants:
+        call = parse_call(v, sample=sample, svtype_map=svtype_map)
+        if is_long_enough(call, minlength):
+            yield call
+
+
+def is_long_enough(call, minlength):
+    """Check the length of intrachromosomal calls, interchromosomal calls have no length"""
+    if call.chrom == call.chr2 and call.svtype not in ("BND", "TRA"):
+        return call.svlen >= minlength
+    return True
+
+
+def parse_call(v, sample, svtype_map=None):
+    """Extract the coordinates and properties of an SV from a cyvcf2 Variant
+
+    Types in svtype_map are renamed, also in symbolic ALT alleles.
+    """
+    svtype = get_call_type(v)
+    alt = v.ALT
+    if svtype_map:
+        svtype = svtype_map.get(svtype, svtype)
+        alt = [utils.rename_svtype(a, svtype_map) for a in alt]
+    chr2 = v.INFO.get("CHR2") or v.CHROM
+    end = v.INFO.get("END") or v.end
+    if svtype == "BND" and v.ALT:
+        mate = BND_MATE.search(v.ALT[0])
+        if mate:
+            chr2, end = mate.group(1), int(mate.group(2))
+    return SVCall(
+        chrom=v.CHROM,
+        start=v.start,
+        chr2=chr2,
+        end=end,
+        svtype=svtype,
+        svlen=get_call_length(v, svtype, chr2),
+        strands=get_call_strands(v, svtype),
+        sample=sample,
+        gt=GT_STRINGS[v.gt_types[0]],
+        id=v.ID or ".",
+        ref=v.REF,
+        alt=",".join(alt) or ".",
+    )
+
+
+def get_call_type(v):
+    svtype = v.INFO.get("SVTYPE")
+    if svtype is None:
+        svtype = v.ALT[0].strip("<>") if v.ALT else "NA"
+    if svtype == "INVDUP":
+        return "INV"
+    return svtype.split(":")[0].split("/")[0]
+
+
+def get_call_length(v, svtype, chr2):
+    svlen = v.INFO.get("SVLEN")
+    if isinstance(svlen, tuple):
+        svlen = svlen[0]
+    if svlen is not None:
+        return abs(int(svlen))
+    if chr2 != v.CHROM:
+        return 0
+    if svtype == "INS" and v.ALT and not v.ALT[0].startswith("<"):
+        return abs(len(v.ALT[0]) - len(v.REF))
+    return v.end - v.start
+
+
+def get_call_strands(v, svtype):
+    """Return the strands of the call from INFO/STRANDS or the type of SV, '..' if unknown"""
+    strands = v.INFO.get("STRANDS")
+    if strands:
+        return strands[:2]
+    return {"DEL": "+-", "INS": "+-", "DUP": "-+"}.get(svtype, "..")
+
+
+def compatible(first, second, distance, require_type, require_strand):
+    """Check if two calls are concordant"""
+    if first.chr2 != second.chr2:
+        return False
+    if require_type and first.svtype != second.svtype:
+        return False
+    if require_strand and ".." not in (first.strands, second.strands):
+        if first.strands != second.strands:
+            return False
+    return abs(first.start - second.start) <= distance and abs(first.end - second.end) <= distance
+
+
+def cluster_calls(calls, distance, require_type, require_strand, estimate_distance=False):
+    """Cluster calls sorted by chromosome and start coordinate
+
+    Every cluster is represented by its first call, and a new call is added to the closest
+    compatible cluster. Clusters of which the representative is more than <distance> upstream
+    of the current call can't grow anymore and are yielded, which keeps them sorted.
+    If estimate_distance is True the allowed distance is the length of the largest SV,
+    capped at <distance>.
+    """
+    active = deque()
+    chrom = None
+    for call in calls:
+        if call.chrom != chrom:
+            yield from active
+            active.clear()
+            chrom = call.chrom
+        while active and call.start - active[0][0].start > distance:
+            yield active.popleft()
+        best, best_distance = None, None
+        for cluster in active:
+            rep = cluster[0]
+            max_dist = min(distance, max(rep.svlen, call.svlen)) if estimate_distance else distance
+            if compatible(rep, call, max_dist, require_type, require_strand):
+                dist = abs(rep.start - call.start) + abs(rep.end - call.end)
+                if best is None or dist < best_distance:
+                    best, best_distance = cluster, dist
+        if best is None:
+            active.append([call])
+        else:
+            best.append(call)
+    yield from active
+
+
+def make_header(contigs, names):
+    header = ["##fileformat=VCFv4.1", "##source=surpyvor merge"]
+    for contig, length in contigs.items():
+        if length:
+            header.append(f"##contig=<ID={contig},length={length}>")
+        else:
+            header.append(f"##contig=<ID={contig}>")
+    header.extend(
+        [
+            '##ALT=<ID=DEL,Description="Deletion">',
+            '##ALT=<ID=DUP,Description="Duplication">',
+            '##ALT=<ID=INV,Description="Inversion">',
+            '##ALT=<ID=BND,Description="Translocation">',
+            '##ALT=<ID=INS,Description="Insertion">',
+            '##INFO=<ID=SUPP,Number=1,Type=Integer,Description="Number of samples supporting the variant">',
+            '##INFO=<ID=SUPP_VEC,Number=1,Type=String,Description="Vector of supporting samples.">',
+            '##INFO=<ID=SVLEN,Number=1,Type=Integer,Description="Length of the SV">',
+            '##INFO=<ID=SVTYPE,Number=1,Type=String,Description="Type of the SV.">',
+            '##INFO=<ID=SVMETHOD,Number=1,Type=String,Description="Method used to merge the SVs">',
+            '##INFO=<ID=CHR2,Number=1,Type=String,Description="Chromosome for END coordinate">',
+            '##INFO=<ID=END,Number=1,Type=Integer,Description="End of the structural variant">',
+            '##INFO=<ID=STRANDS,Number=1,Type=String,Description="Indicating the direction of the reads with respect to the type and breakpoint.">',
+            '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">',
+            '##FORMAT=<ID=LN,Number=1,Type=Integer,Description="Predicted length">',
+            '##FORMAT=<ID=ST,Number=1,Type=String,Description="Predicted strands">',
+            '##FORMAT=<ID=TY,Number=1,Type=String,Description="Predicted type">',
+            '##FORMAT=<ID=ID,Number=1,Type=String,Description="Variant ID from input">',
+            '##FORMAT=<ID=CO,Number=1,Type=String,Description="Coordinates">',
+            "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t{}".format("\t".join(names)),
+        ]
+    )
+    return header
+
+
+def format_cluster(cluster, num_samples):
+    """Return the vcf line of a cluster of calls, with a column for every sample"""
+    rep = cluster[0]
+    columns = ["./.:.:.:.:.:."] * num_samples
+    supp_vec = ["0"] * num_samples
+    for call in reversed(cluster):  # the first call of a sample takes precedence
+        columns[call.sample] = "{}:{}:{}:{}:{}:{}_{}-{}_{}".format(
+            call.gt,
+            call.svlen,
+            call.strands,
+            call.svtype,
+            call.id,
+            call.chrom,
+            call.start + 1,
+            call.chr2,
+            call.end,
+        )
+        supp_vec[call.sample] = "1"
+    info = {
+        "SUPP": supp_vec.count("1"),
+        "SUPP_VEC": "".join(supp_vec),
+        "SVLEN": rep.svlen,
+        "SVTYPE": rep.svtype,
+        "SVMETHOD": "surpyvor",
+        "CHR2": rep.chr2,
+        "END": rep.end,
+        "STRANDS": rep.strands,
+    }
+    return "\t".join(
+        [
+            rep.chrom,
+            str(rep.start + 1),
+            rep.id,
+            rep.ref,
+            rep.alt,
+            ".",
+            "PASS",
+            ";".join(f"{k}={v}" for k, v in info.items()),
+            "GT:LN:ST:TY:ID:CO",
+        ]
+        + columns
+    )
+
+
+def write_merged(clusters, output, contigs, names, callers=1):
+    """Write clusters supported by at least <callers> samples to output"""
+    with utils.open_output(output) as out:
+        out.write("\n".join(make_header(contigs, names)) + "\n")
+        for cluster in clusters:
+            if len({call.sample for call in cluster}) >= callers:
+                out.write(format_cluster(cluster, num_samples=len(names)) + "\n")
@@ -0,0 +1,176 @@
+"""
+Parallel execution of merging and transforming vcf files per chromosome.
+
+The inputs are split per contig using tabix region queries, and every contig is merged in a
+separate process. Records are assigned to the contig in their CHROM column, and
+interchromosomal calls (translocations and BNDs with a mate on another contig) are merged
+together in a separate shard, so that merging them doesn't depend on how contigs are divided
+over the workers. The sorted per-contig outputs are combined in the order of the contigs in
+the header, with the interchromosomal shard merged in by position.
+"""
+
+import os
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from cyvcf2 import VCF
+from surpyvor import utils
+
+
+def sharded_merge(samples, output, threads, **merge_kwargs):
+    """Merge samples with surpyvor.sv_merge per contig, using <threads> processes"""
+    vcffiles = [utils.compress_and_tabix(s) for s in samples]
+    contigs = list(utils.get_contigs(vcffiles))
+    if not contigs:
+        sys.exit("ERROR: --threads requires contig lines in the vcf header to split the input.")
+    engine = "native merge" if merge_kwargs.get("engine") == "native" else "SURVIVOR"
+    print(
+        f"Executing {engine} on {len(contigs)} contigs using {threads} processes...",
+        end="",
+        flush=True,
+        file=sys.stderr,
+    )
+    with ProcessPoolExecutor(max_workers=threads) as pool:
+        splits = list(pool.map(split_contig, [vcffiles] * len(contigs), contigs))
+        shards = [s[0] for s in splits if s[0]]
+        interchromosomal = combine_interchromosomal(vcffiles, [s[1] for s in splits])
+        if interchromosomal:
+            shards.append(interchromosomal)
+        merged = list(pool.map(merge_shard, shards, [merge_kwargs] * len(shards)))
+    if merged:
+        combine_shards(merged, output)
+    else:  # no records: merge the inputs as a whole to write the merged header
+        from surpyvor.surpyvor import sv_merge
+
+        sv_merge(samples=samples, output=output, quiet=True, **merge_kwargs)
+    print("DONE", file=sys.stderr)
+
+
+def split_contig(vcffiles, contig):
+    """Write the intrachromosomal records of contig to a shard file per input vcf
+
+    Returns the list of shard files (or None if the contig has no records)
+    and per input vcf the interchromosomal records of this contig.
+    """
+    shard = []
+    interchromosomal = []
+    records = 0
+    for vcffile in vcffiles:
+        vcf = utils.open_vcf(vcffile)
+        handle, name = tempfile.mkstemp(suffix=".vcf")
+        inter = []
+        with os.fdopen(handle, "w") as out:
+            out.write(vcf.raw_header)
+            for v in vcf(contig):
+                if is_interchromosomal(v):
+                    inter.append(str(v))
+                else:
+                    out.write(str(v))
+                    records += 1
+        vcf.close()
+        shard.append(name)
+        interchromosomal.append(inter)
+    return shard if records else None, interchromosomal
+
+
+def is_interchromosomal(v):
+    if v.INFO.get("CHR2") not in (None, v.CHROM):
+        return True
+    if v.INFO.get("SVTYPE") == "BND" and v.ALT:
+        from surpyvor.nativemerge import BND_MATE
+
+        mate = BND_MATE.search(v.ALT[0])
+        return bool(mate) and mate.group(1) != v.CHROM
+    return False
+
+
+def combine_interchromosomal(vcffiles, records_per_contig):
+    """Write the interchromosomal records of every input vcf to a shard file
+
+    records_per_contig is a list (per contig, in header order) of lists (per input vcf)
+    of records, so that concatenating them per input vcf keeps the records sorted.
+    Returns None if there are no interchromosomal records.
+    """
+    if not any(any(inter) for inter in records_per_contig):
+        return None
+    shard = []
+    for index, vcffile in enumerate(vcffiles):
+        vcf = VCF(vcffile)
+        handle, name = tempfile.mkstemp(suffix=".vcf")
+        with os.fdopen(handle, "w") as out:
+            out.write(vcf.raw_header)
+            vcf.close()
+            for records in records_per_contig:
+                out.write("".join(records[index]))
+        shard.append(name)
+    return shard
+
+
+def merge_shard(shard, merge_kwargs):
+    from surpyvor.surpyvor import sv_merge
+
+    output = utils.temp_path(suffix=".vcf")
+    sv_merge(samples=shard, output=output, quiet=True, **merge_kwargs)
+    return output
+
+
+def combine_shards(merged, output):
+    """Write the header of the first shard and the records of all shards in sorted order
+
+    All but the last shard hold a single contig and are ordered by contig,
+    so the heap merge only interleaves the interchromosomal shard.
+    """
+    if not merged:
+        sys.exit("ERROR: no merged shards to combine.")
+    with open(merged[0]) as first:
+        header = [line for line in first if line.startswith("#")]
+    with utils.open_output(output) as out:
+        out.write("".join(header))
+        for v in utils.merge_sorted_vcfs(merged):
+            out.write(str(v))
+
+
+def sharded_transform(vcf, output, threads, regions=None, **transform_kwargs):
+    """Run utils.transform_vcf per contig using <threads> processes, returning the summed counts
+
+    Every contig (or the regions on that contig) is written to a shard file,
+    and the shards are concatenated in the order of the contigs in the header.
+    """
+    from collections import Counter
+
+    vcffile = utils.compress_and_tabix(vcf)
+    vcf = VCF(vcffile)
+    contigs = vcf.seqnames
+    vcf.close()
+    if regions:
+        shard_regions = [[r for r in regions if r[0] == c] for c in contigs]
+        shard_regions = [r for r in shard_regions if r]
+    else:
+        shard_regions = [[(c, 0, None)] for c in contigs]
+    if not shard_regions:
+        return utils.transform_vcf(vcffile, output, regions=regions, **transform_kwargs)
+    with ProcessPoolExecutor(max_workers=threads) as pool:
+        shards = list(
+            pool.map(
+                transform_shard,
+                [vcffile] * len(shard_regions),
+                shard_regions,
+                [transform_kwargs] * len(shard_regions),
+            )
+        )
+    with open(shards[0][0]) as first:
+        header = [line for line in first if line.startswith("#")]
+    with utils.open_output(output) as out:
+        out.write("".join(header))
+        for shard, _ in shards:
+            with open(shard) as records:
+                for line in records:
+                    if not line.startswith("#"):
+                        out.write(line)
+    return sum((counts for _, counts in shards), Counter())
+
+
+def transform_shard(vcffile, regions, transform_kwargs):
+    output = utils.temp_path(suffix=".vcf")
+    counts = utils.transform_vcf(vcffile, output, regions=regions, **transform_kwargs)
+    return output, counts
@@ -1,10 +1,22 @@
-from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from argparse import Action, ArgumentParser, ArgumentDefaultsHelpFormatter, SUPPRESS
+from functools import lru_cache
 from .version import __version__
+from .cache import default_cache_dir
 import sys
 from os import path
 
 
-def get_args():
+def get_args(argv=None):
+    """Parse and validate argv, by default the command line arguments"""
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    validate_args(parser, args)
+    return args
+
+
+@lru_cache(maxsize=1)
+def get_parser():
+    """Build the argument parser, once per process as batch parses many argument lists"""
     parser = ArgumentParser(
         description="A wrapper around SURVIVOR, with convenience functions.",
         formatter_class=ArgumentDefaultsHelpFormatter,
@@ -12,8 +24,7 @@ def get_args():
     parser.add_argument(
         "-v",
         "--version",
-        action="version",
-        version="surpyvor: {}, SURVIVOR {}".format(__version__, get_survivor_version()),
+        action=VersionAction,
         help="Print version and quit.",
     )
 
@@ -28,8 +39,77 @@ def get_args():
     parent_parser.add_argument(
         "--verbose", help="Print out more information while running.", action="store_true"
     )
+    parent_parser.add_argument(
+        "--tmpdir",
+        help="Directory in which a scratch directory for intermediate files is created, "
+        "which is removed when finished. Defaults to the system temporary directory.",
+        default=None,
+    )
+    parent_parser.add_argument(
+        "--io-threads",
+        help="Number of threads for (de)compressing vcf files. "
+        "Output ending in .vcf.gz is bgzip-compressed and indexed.",
+        type=int,
+        default=1,
+    )
+    parent_parser.add_argument(
+        "--profile",
+        help="Report the wall time, records processed and peak memory of every stage, "
+        "as a table on stderr, or written to a file (as JSON if it ends with .json).",
+        nargs="?",
+        const="-",
+        metavar="FILE",
+    )
+    parent_parser.add_argument(
+        "--profile-python",
+        help="Also profile the Python stages with cProfile or pyinstrument.",
+        choices=["cprofile", "pyinstrument"],
+    )
+    parent_parser.add_argument(
+        "--profile-dir",
+        help="Directory to write the --profile-python files to.",
+        default="surpyvor_profile",
+    )
+    engine_parser = ArgumentParser(add_help=False)
+    engine_parser.add_argument(
+        "--engine",
+        help="Merge SVs with SURVIVOR or with the in-process native engine.",
+        choices=["survivor", "native"],
+        default="survivor",
+    )
+    engine_parser.add_argument(
+        "-t",
+        "--threads",
+        help="Number of processes to merge chromosomes in parallel.",
+        type=int,
+        default=1,
+    )
+    cache_parser = ArgumentParser(add_help=False)
+    cache_parser.add_argument(
+        "--no-cache", help="Don't use or store cached merged vcf files.", action="store_true"
+    )
+    cache_parser.add_argument(
+        "--cache-dir", help="Directory to cache merged vcf files.", default=default_cache_dir()
+    )
+    cache_parser.add_argument(
+        "--cache-size",
+        help="Maximal size of the cache in MB, least recently used files are removed first.",
+        type=int,
+        default=2000,
+    )
+    region_parser = ArgumentParser(add_help=False)
+    region_parser.add_argument(
+        "--region",
+        help="Only use records in this region (chr, chr:start or chr:start-end), "
+        "can be used multiple times.",
+        action="append",
+    )
+    region_parser.add_argument("--regions-file", help="Only use records in regions of a BED file.")
+    region_parser.add_argument("--samples", help="Comma-separated list of samples to use.")
     subparsers = parser.add_subparsers(dest="command", title="[sub-commands]")
-    merge = subparsers.add_parser("merge", help="merging vcf files of SVs", parents=[parent_parser])
+    merge = subparsers.add_parser(
+        "merge", help="merging vcf files of SVs", parents=[parent_parser, engine_parser]
+    )
     merge_req = merge.add_argument_group("required arguments")
     merge_req.add_argument("--variants", nargs="+", required=True, help="vcf files to merge")
     merge_opt = merge.add_argument_group("optional arguments")
@@ -66,7 +146,7 @@ def get_args():
     )
 
     highsens = subparsers.add_parser(
-        "highsens", help="get union of SV vcfs", parents=[parent_parser]
+        "highsens", help="get union of SV vcfs", parents=[parent_parser, engine_parser]
     )
     highsens_req = highsens.add_argument_group("required arguments")
     highsens_req.add_argument("--variants", nargs="+", required=True, help="vcf files to merge")
@@ -79,7 +159,7 @@ def get_args():
         "-l", "--minlength", type=int, default=50, help="Minimum length of variants to consider"
     )
     highconf = subparsers.add_parser(
-        "highconf", help="get intersection of SV vcfs", parents=[parent_parser]
+        "highconf", help="get intersection of SV vcfs", parents=[parent_parser, engine_parser]
     )
     highconf_req = highconf.add_argument_group("required arguments")
     highconf_req.add_argument("--variants", nargs="+", required=True, help="vcf files to merge")
@@ -95,17 +175,23 @@ def get_args():
         "-s", "--strand", action="store_true", default=False, help="Take strand into account"
     )
     prf = subparsers.add_parser(
-        "prf", help="calculate precision, recall and F-measure", parents=[parent_parser]
+        "prf",
+        help="calculate precision, recall and F-measure",
+        parents=[parent_parser, engine_parser, cache_parser],
     )
     prf_req = prf.add_argument_group("required arguments")
-    prf_req.add_argument("--truth", help="vcf containing truth set", required=True)
-    prf_req.add_argument("--test", help="vcf containing test set", required=True)
+    prf_req.add_argument("--truth", help="vcf(s) containing truth set", required=True, nargs="+")
+    prf_req.add_argument("--test", help="vcf(s) containing test set", required=True, nargs="+")
     prf_opt = prf.add_argument_group("optional arguments")
     prf_opt.add_argument(
-        "-d", "--distance", help="maximum distance between test and truth call", default=500
+        "-d",
+        "--distance",
+        type=int,
+        help="maximum distance between test and truth call",
+        default=500,
     )
     prf_opt.add_argument(
-        "--minlength", help="Minimum length of SVs to be taken into account", default=50
+        "--minlength", type=int, help="Minimum length of SVs to be taken into account", default=50
     )
     prf_opt.add_argument(
         "-i",
@@ -128,9 +214,16 @@ def get_args():
     )
     prf_opt.add_argument("--matrix", help="Make a confusion matrix.", action="store_true")
     prf_opt.add_argument("--venn", help="Make a venn diagram.", action="store_true")
+    prf_opt.add_argument(
+        "--stratify",
+        help="Also report precision and recall per SV type and length bin.",
+        action="store_true",
+    )
 
     venn = subparsers.add_parser(
-        "venn", help="Make venn diagram for 2 or 3 SV vcf files", parents=[parent_parser]
+        "venn",
+        help="Make venn diagram for 2 or 3 SV vcf files",
+        parents=[parent_parser, engine_parser, cache_parser],
     )
     venn_req = venn.add_argument_group("required arguments")
     venn_req.add_argument(
@@ -139,10 +232,14 @@ def get_args():
     venn_opt = venn.add_argument_group("optional arguments")
     venn_opt.add_argument("--names", help="Names of datasets in --variants", nargs="*")
     venn_opt.add_argument(
-        "-d", "--distance", help="maximum distance between test and truth call", default=500
+        "-d",
+        "--distance",
+        type=int,
+        help="maximum distance between test and truth call",
+        default=500,
     )
     venn_opt.add_argument(
-        "--minlength", help="Minimum length of SVs to be taken into account", default=50
+        "--minlength", type=int, help="Minimum length of SVs to be taken into account", default=50
     )
     venn_opt.add_argument(
         "-i",
@@ -155,7 +252,9 @@ def get_args():
     venn_opt.add_argument("--plotout", help="Name of output plot", default="venn.png")
 
     upset = subparsers.add_parser(
-        "upset", help="Make upset plot for multiple SV vcf files", parents=[parent_parser]
+        "upset",
+        help="Make upset plot for multiple SV vcf files",
+        parents=[parent_parser, engine_parser, cache_parser],
     )
     upset_req = upset.add_argument_group("required arguments")
     upset_req.add_argument(
@@ -164,10 +263,14 @@ def get_args():
     upset_opt = upset.add_argument_group("optional arguments")
     upset_opt.add_argument("--names", help="Names of datasets in --variants", nargs="*")
     upset_opt.add_argument(
-        "-d", "--distance", help="maximum distance between test and truth call", default=500
+        "-d",
+        "--distance",
+        type=int,
+        help="maximum distance between test and truth call",
+        default=500,
     )
     upset_opt.add_argument(
-        "--minlength", help="Minimum length of SVs to be taken into account", default=50
+        "--minlength", type=int, help="Minimum length of SVs to be taken into account", default=50
     )
     upset_opt.add_argument(
         "-i",
@@ -178,16 +281,37 @@ def get_args():
     )
     upset_opt.add_argument("--keepmerged", help="Save merged vcf file")
     upset_opt.add_argument("--plotout", help="Name of output plot", default="UpSetPlot.png")
+    upset_opt.add_argument(
+        "--max-intersections",
+        help="Only plot this number of largest intersections",
+        type=int,
+        default=None,
+    )
+    upset_opt.add_argument(
+        "--countsout", help="Write the observed intersections and their counts to this file"
+    )
 
     haplomerge = subparsers.add_parser(
         "haplomerge",
         help="merging vcf files of SVs from two haplotypes",
         formatter_class=ArgumentDefaultsHelpFormatter,
-        parents=[parent_parser],
+        parents=[parent_parser, engine_parser, cache_parser],
     )
     haplomerge_req = haplomerge.add_argument_group("required arguments")
-    haplomerge_req.add_argument("--variants", required=True, nargs="*", help="vcf files to merge")
+    haplomerge_req.add_argument(
+        "--variants", nargs="*", help="vcf files of hap1, hap2 and optionally unphased calls"
+    )
     haplomerge_opt = haplomerge.add_argument_group("optional arguments")
+    haplomerge_opt.add_argument(
+        "--samples-file",
+        help="tab-separated file with per line a sample name and its hap1, hap2 and optionally "
+        "unphased vcf file, to merge many samples with the native engine instead of --variants",
+    )
+    haplomerge_opt.add_argument(
+        "--outdir",
+        help="directory to write <name>.vcf.gz to for every sample in --samples-file",
+        default=".",
+    )
     haplomerge_opt.add_argument("-o", "--output", help="output file", default="stdout")
     haplomerge_opt.add_argument(
         "-n", "--name", help="name of sample in output VCF", default="stdout"
@@ -226,7 +350,7 @@ def get_args():
     lengthplot = subparsers.add_parser(
         "lengthplot",
         help="create stacked bar plot of SV lengths split by type",
-        parents=[parent_parser],
+        parents=[parent_parser, region_parser],
     )
     lengthplot_req = lengthplot.add_argument_group("required arguments")
     lengthplot_req.add_argument("vcf", help="vcf file to parse")
@@ -241,7 +365,9 @@ def get_args():
         "--all", help="Plot all variants and not just the first in the file", action="store_true"
     )
     minlength = subparsers.add_parser(
-        "minlen", help="filter a SV vcf file by minimal variant length", parents=[parent_parser]
+        "minlen",
+        help="filter a SV vcf file by minimal variant length",
+        parents=[parent_parser, region_parser],
     )
     minlength_req = minlength.add_argument_group("required arguments")
     minlength_req.add_argument("vcf", help="vcf file to parse")
@@ -249,11 +375,18 @@ def get_args():
     minlength_opt = minlength.add_argument_group("optional arguments")
     minlength_opt.add_argument("-l", "--length", help="minimal SV length", type=int, default=50)
     minlength_opt.add_argument("-o", "--output", help="vcf file to write to", default=None)
+    minlength_opt.add_argument(
+        "-t",
+        "--threads",
+        help="Number of processes to process chromosomes in parallel.",
+        type=int,
+        default=1,
+    )
 
     truncate_svlen = subparsers.add_parser(
         "svlentruncate",
         help="limit the SVLEN to a certain (positive) length",
-        parents=[parent_parser],
+        parents=[parent_parser, region_parser],
     )
     truncate_svlen_req = truncate_svlen.add_argument_group("required arguments")
     truncate_svlen_req.add_argument("vcf", help="vcf file to parse")
@@ -267,15 +400,31 @@ def get_args():
         default=1e5,
     )
     truncate_svlen_opt.add_argument("-o", "--output", help="vcf file to write to", default=None)
+    truncate_svlen_opt.add_argument(
+        "-t",
+        "--threads",
+        help="Number of processes to process chromosomes in parallel.",
+        type=int,
+        default=1,
+    )
 
     fixvcf = subparsers.add_parser(
-        "fixvcf", help="Some fixes to make compatible with e.g. vcfanno", parents=[parent_parser]
+        "fixvcf",
+        help="Some fixes to make compatible with e.g. vcfanno",
+        parents=[parent_parser, region_parser],
     )
     fixvcf_req = fixvcf.add_argument_group("required arguments")
     fixvcf_req.add_argument("vcf", help="vcf file to parse")
     fixvcf_req.add_argument("--fai", help="index of corresponding fasta file", required=True)
     fixvcf_opt = fixvcf.add_argument_group("optional arguments")
     fixvcf_opt.add_argument("-o", "--output", help="vcf file to write to", default="stdout")
+    fixvcf_opt.add_argument(
+        "-t",
+        "--threads",
+        help="Number of processes to process chromosomes in parallel.",
+        type=int,
+        default=1,
+    )
     fixvcf_opt.add_argument(
         "--jasmine", help="Fix problems related to using jasmine", action="store_true"
     )
@@ -290,9 +439,18 @@ def get_args():
     purge2d_opt.add_argument(
         "-o", "--output", help="sam/bam file to write filtered alignments to [stdout]", default="-"
     )
+    purge2d_opt.add_argument(
+        "-t",
+        "--threads",
+        help="Number of processes to filter chromosomes in parallel.",
+        type=int,
+        default=1,
+    )
 
     carrierplot = subparsers.add_parser(
-        "carrierplot", help="show number of carriers per variant", parents=[parent_parser]
+        "carrierplot",
+        help="show number of carriers per variant",
+        parents=[parent_parser, region_parser],
     )
     carrierplot_req = carrierplot.add_argument_group("required arguments")
     carrierplot_req.add_argument("variants", help="VCF to plot from")
@@ -303,7 +461,9 @@ def get_args():
     )
 
     varcount = subparsers.add_parser(
-        "varcount", help="plot number of variants per sample in a vcf file", parents=[parent_parser]
+        "varcount",
+        help="plot number of variants per sample in a vcf file",
+        parents=[parent_parser, region_parser],
     )
     varcount_req = varcount.add_argument_group("required arguments")
     varcount_req.add_argument("variants", help="VCF to plot from")
@@ -316,16 +476,69 @@ def get_args():
         "--countsout", help="output file to write counts to", default="SV-counts.txt"
     )
 
+    index = subparsers.add_parser(
+        "index",
+        help="write a sidecar file with SV summary data for faster plots and statistics",
+        parents=[parent_parser],
+    )
+    index_req = index.add_argument_group("required arguments")
+    index_req.add_argument("variants", nargs="+", help="vcf files to index")
+
+    sort = subparsers.add_parser(
+        "sort",
+        help="sort a vcf file by the contig order in the header and position",
+        parents=[parent_parser],
+    )
+    sort_req = sort.add_argument_group("required arguments")
+    sort_req.add_argument("vcf", help="vcf file to sort")
+    sort_opt = sort.add_argument_group("optional arguments")
+    sort_opt.add_argument("-o", "--output", help="vcf file to write to", default="stdout")
+    sort_opt.add_argument(
+        "--max-records",
+        help="Number of records to hold in memory, more are spilled to temporary files.",
+        type=int,
+        default=200000,
+    )
+
     fixref = subparsers.add_parser(
-        "fixref", help="Fix reference allele in vcf file", parents=[parent_parser]
+        "fixref", help="Fix reference allele in vcf file", parents=[parent_parser, region_parser]
     )
     fixref_req = fixref.add_argument_group("required arguments")
     fixref_req.add_argument("variants", help="VCF to fix")
     fixref_req.add_argument("--fasta", help="fasta file", required=True)
+    fixref_opt = fixref.add_argument_group("optional arguments")
+    fixref_opt.add_argument("-o", "--output", help="vcf file to write to", default="stdout")
+    fixref_opt.add_argument(
+        "--max-ref-len",
+        help="Use a symbolic ALT allele instead of REF alleles longer than this.",
+        type=int,
+        default=None,
+    )
 
-    args = parser.parse_args()
-    validate_args(parser, args)
-    return args
+    batch = subparsers.add_parser(
+        "batch",
+        help="run a sub-command for every line of a manifest, using a pool of processes",
+        parents=[parent_parser],
+    )
+    batch_req = batch.add_argument_group("required arguments")
+    batch_req.add_argument(
+        "manifest",
+        help="tab-separated file with per line the sub-command and its arguments, "
+        "such as: minlen<TAB>sample.vcf<TAB>-o<TAB>sample.filtered.vcf",
+    )
+    batch_opt = batch.add_argument_group("optional arguments")
+    batch_opt.add_argument(
+        "--command",
+        dest="batch_command",
+        help="sub-command to run for every line, which then only has the arguments",
+    )
+    batch_opt.add_argument(
+        "-j", "--jobs", help="Number of jobs to run in parallel.", type=int, default=1
+    )
+    batch_opt.add_argument(
+        "--report", help="tab-separated file to write the status and timing of every job to"
+    )
+    return parser
 
 
 def validate_args(parser, args):
@@ -343,9 +556,26 @@ def validate_args(parser, args):
         if len(args.variants) > 3:
             sys.exit("INPUT ERROR: " "Venn diagrams are only created for 2 or 3 vcf files!")
     if args.command == "haplomerge":
-        if not len(args.variants) in [2, 3]:
+        if args.samples_file:
+            if args.variants:
+                sys.exit("INPUT ERROR: " "use either --variants or --samples-file!")
+            if args.engine != "native":
+                sys.exit("INPUT ERROR: " "--samples-file requires --engine native!")
+            if not path.isfile(args.samples_file):
+                sys.exit(f"File not found: {args.samples_file}")
+        elif not args.variants or not len(args.variants) in [2, 3]:
             sys.exit("INPUT ERROR: " "haplomerge can only be used on 2 or 3 vcf files!")
-    if hasattr(args, "variants"):
+    if args.profile_python and not args.profile:
+        args.profile = "-"
+    if args.command == "sort":
+        if not path.isfile(args.vcf):
+            sys.exit(f"File not found: {args.vcf}")
+        if args.max_records < 1:
+            sys.exit("INPUT ERROR: " "--max-records should be at least 1!")
+    if args.command == "batch":
+        if not path.isfile(args.manifest):
+            sys.exit(f"File not found: {args.manifest}")
+    if getattr(args, "variants", None) is not None:
         if isinstance(args.variants, list):
             for f in args.variants:
                 if not path.isfile(f):
@@ -353,20 +583,38 @@ def validate_args(parser, args):
         else:
             if not path.isfile(args.variants):
                 sys.exit(f"File not found: {args.variants}")
-    if hasattr(args, "truth"):
-        if not path.isfile(args.truth):
-            sys.exit("File not found: {}".format(args.truth))
-    if hasattr(args, "test"):
-        if not path.isfile(args.test):
-            sys.exit("File not found: {}".format(args.test))
+    if args.command == "prf":
+        for f in args.truth + args.test:
+            if not path.isfile(f):
+                sys.exit("File not found: {}".format(f))
+        if (args.venn or args.bar or args.matrix) and len(args.truth) + len(args.test) > 2:
+            sys.exit(
+                "INPUT ERROR: "
+                "--venn, --bar and --matrix require a single --truth and a single --test vcf!"
+            )
+
+
+class VersionAction(Action):
+    """Print the version of surpyvor and SURVIVOR, running SURVIVOR only when asked for"""
+
+    def __init__(self, option_strings, dest=SUPPRESS, default=SUPPRESS, help=None):
+        super().__init__(option_strings, dest=dest, default=default, nargs=0, help=help)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        print("surpyvor: {}, SURVIVOR {}".format(__version__, get_survivor_version()))
+        parser.exit()
 
 
 def get_survivor_version():
     import subprocess
 
-    for line in subprocess.check_output(
-        args="SURVIVOR", stderr=subprocess.STDOUT, universal_newlines=True
-    ).split("\n"):
+    try:
+        output = subprocess.check_output(
+            args="SURVIVOR", stderr=subprocess.STDOUT, universal_newlines=True
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return "not found"
+    for line in output.split("\n"):
         if line.startswith("Version:"):
             return line.strip().split(" ")[1]
     else:
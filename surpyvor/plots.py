@@ -1,4 +1,7 @@
-import matplotlib.pyplot as plt
+import matplotlib
+
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt  # noqa: E402
 
 
 def bar_chart(vcf, outname="stacked_bar.png"):
@@ -6,23 +9,21 @@ def bar_chart(vcf, outname="stacked_bar.png"):
     Make a stacked bar chart for length of the SV split by validation status
     This ignores zygosity.
     """
-    from cyvcf2 import VCF
     from surpyvor import utils
     import numpy as np
 
-    len_dict = {"True": [], "False": [], "Missed": []}
-    for v in VCF(vcf):
-        if not v.INFO.get("SVTYPE") == "TRA" and abs(v.INFO.get("SVLEN")) >= 50:
-            calls = [utils.is_variant(call) for call in v.gt_types]
-            if calls == [True, True]:
-                len_dict["True"].append(v.INFO.get("SVLEN"))
-            elif calls == [False, True]:
-                len_dict["False"].append(v.INFO.get("SVLEN"))
-            elif calls == [True, False]:
-                len_dict["Missed"].append(v.INFO.get("SVLEN"))
+    gm = utils.genotype_matrix(vcf)
+    variants = utils.is_variant_array(gm.gt[:, :2])
+    tra = np.isin(gm.svtype, [i for i, t in enumerate(gm.svtypes) if t == "TRA"])
+    keep = ~tra & (np.abs(gm.svlen) >= 50)
+    len_dict = {
+        "True": gm.svlen[keep & variants[:, 0] & variants[:, 1]],
+        "False": gm.svlen[keep & ~variants[:, 0] & variants[:, 1]],
+        "Missed": gm.svlen[keep & variants[:, 0] & ~variants[:, 1]],
+    }
     plt.subplot(2, 1, 1)
     plt.hist(
-        x=np.array(list(len_dict.values())),
+        x=list(len_dict.values()),
         bins=[i for i in range(0, 2000, 10)],
         stacked=True,
         histtype="bar",
@@ -33,7 +34,7 @@ def bar_chart(vcf, outname="stacked_bar.png"):
     plt.legend(frameon=False, fontsize="small")
     plt.subplot(2, 1, 2)
     plt.hist(
-        x=np.array(list(len_dict.values())),
+        x=list(len_dict.values()),
         bins=[i for i in range(0, 20000, 100)],
         stacked=True,
         histtype="bar",
@@ -48,18 +49,17 @@ def bar_chart(vcf, outname="stacked_bar.png"):
     plt.close()
 
 
-def num_variants_per_sample(vcf, outname="num_variants_per_sample.png", counts_out="counts.txt"):
+def num_variants_per_sample(
+    vcf, outname="num_variants_per_sample.png", counts_out="counts.txt", regions=None, samples=None
+):
     """
     Make a scatter plot of the number of variants per sample
     """
-    from cyvcf2 import VCF
-    import numpy as np
+    from surpyvor import utils
 
-    vcf = VCF(vcf)
-    calls = np.zeros(len(vcf.samples))
-    for v in vcf:
-        calls += np.array([int(g in [1, 3]) for g in v.gt_types])
-    ids = vcf.samples
+    gm = utils.genotype_matrix(vcf, regions=regions, samples=samples)
+    calls = utils.is_variant_array(gm.gt).sum(axis=0)
+    ids = gm.samples
     # sort the counts and ids by counts
     counts, ids = zip(*sorted(zip(calls.tolist(), ids), reverse=True))
     with open(counts_out, "w") as out:
@@ -83,51 +83,50 @@ def upset_plot(upsets, outname="UpSetPlot.png"):
 
 
 def venn_diagram(sets, labels, num_samples=2, outname="venn.png"):
+    """
+    Make a venn diagram of 2 or 3 sorted arrays of unique variant keys
+    The size of every subset is calculated from the membership of the union of all keys
+    """
+    import numpy as np
+
     if num_samples == 2:
         from matplotlib_venn import venn2 as venn
     else:
         from matplotlib_venn import venn3 as venn
-    venn(sets, set_labels=labels)
+    union = sets[0]
+    for keys in sets[1:]:
+        union = np.union1d(union, keys)
+    membership = sum(np.isin(union, keys, assume_unique=True) << i for i, keys in enumerate(sets))
+    subsets = np.bincount(membership, minlength=2**num_samples)[1:]
+    venn(subsets=tuple(subsets.tolist()), set_labels=labels)
     plt.savefig(outname)
     plt.close()
 
 
-def length_plot(dict_of_lengths, output):
+def length_plot(histogram, output):
     """Makes two stacked bar charts
     Plotting two bar charts of number of SVs by length split by SV type
     Use a consistent colouring scheme for those in "standard_order" to
     make comparison reasonable
 
+    The counts are taken from a utils.LengthHistogram, and passed to plt.hist as weights
     First bar chart is up to 2kb with bins of 10bp
     Second bar chart is up to 20kb, with bins of 100bp
      and uses log scaling on the y-axis
     """
     standard_order = ["DEL", "INS", "INV", "DUP"]
-    spec_order = sorted([i for i in dict_of_lengths.keys() if i not in standard_order])
+    spec_order = sorted([i for i in histogram.counts.keys() if i not in standard_order])
     sorter = standard_order + spec_order
-    names, lengths = zip(
-        *sorted(
-            [(svtype, lengths) for svtype, lengths in dict_of_lengths.items()],
-            key=lambda x: sorter.index(x[0]),
-        )
-    )
+    names = sorted(histogram.counts.keys(), key=lambda x: sorter.index(x))
+
     plt.subplot(2, 1, 1)
-    plt.hist(
-        x=lengths, bins=[i for i in range(50, 2000, 10)], stacked=True, histtype="bar", label=names
-    )
+    plot_histogram(histogram, names, start=50, stop=1990, binsize=10)
     plt.xlabel("Length of structural variant")
     plt.ylabel("Number of variants")
     plt.legend(frameon=False, fontsize="small")
 
     plt.subplot(2, 1, 2)
-    plt.hist(
-        x=lengths,
-        bins=[i for i in range(0, 20000, 100)],
-        stacked=True,
-        histtype="bar",
-        label=names,
-        log=True,
-    )
+    plot_histogram(histogram, names, start=0, stop=19900, binsize=100, log=True)
     plt.xlabel("Length of structural variant")
     plt.ylabel("Number of variants")
     plt.legend(frameon=False, fontsize="small")
@@ -135,14 +134,26 @@ def length_plot(dict_of_lengths, output):
     plt.savefig(output)
 
 
-def carrierplot(args):
-    from cyvcf2 import VCF
-    from surpyvor.utils import is_variant
-    import numpy as np
+def plot_histogram(histogram, names, start, stop, binsize, log=False):
+    """Plot the binned counts of a LengthHistogram as a stacked histogram"""
+    edges, counts = zip(*[histogram.histogram(n, start, stop, binsize) for n in names])
+    plt.hist(
+        x=list(edges),
+        bins=range(start, stop + binsize, binsize),
+        weights=list(counts),
+        stacked=True,
+        histtype="bar",
+        label=names,
+        log=log,
+    )
+
+
+def carrierplot(args, regions=None, samples=None):
+    from surpyvor import utils
 
-    vcf = VCF(args.variants)
-    counts = np.array([sum([is_variant(call) for call in v.gt_types]) for v in vcf])
-    plt.hist(x=counts, bins=[i for i in range(1, len(vcf.samples))], histtype="bar")
+    gm = utils.genotype_matrix(args.variants, regions=regions, samples=samples)
+    counts = utils.is_variant_array(gm.gt).sum(axis=1)
+    plt.hist(x=counts, bins=[i for i in range(1, len(gm.samples))], histtype="bar")
     plt.xlabel("Number of carriers")
     plt.ylabel("Number of variants")
     plt.tight_layout()
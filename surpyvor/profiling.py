@@ -0,0 +1,331 @@
+"""
+Profiling the stages of a run: wall time, records processed and peak memory usage.
+
+With --profile, every stage (a Python function such as normalize_vcf or an external tool such
+as SURVIVOR or tabix) records its wall time, the CPU time of surpyvor and of finished
+subprocesses, the number of records processed and the peak resident memory of surpyvor and of
+the largest subprocess during the stage. Stages can be nested, the times and peaks of a stage
+include those of the stages within. The stages are summarized in a table or written as JSON.
+
+The peak memory of surpyvor is measured per stage by resetting the high-water mark (VmHWM)
+at every start and end of a stage, which requires Linux. Elsewhere, a stage only gets a peak
+if it raised the high-water mark of the process. Subprocesses started with call() or waited
+for with wait() get their own peak, other subprocesses (e.g. worker processes) are only
+counted if they are the largest child so far.
+Python stages can also be profiled with cProfile or pyinstrument, writing a file per stage.
+Stages running in worker processes (--threads) are accounted to the stage that started them.
+"""
+
+import json
+import os
+import re
+import resource
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+
+PROFILER = None
+# ru_maxrss is in kilobytes on Linux, in bytes on macOS
+RSS_SCALE = 1 / 1024**2 if sys.platform == "darwin" else 1 / 1024
+
+
+class Stage(object):
+    """A stage being profiled, the code in the stage can set the number of records processed"""
+
+    def __init__(self, name):
+        self.name = name
+        self.records = None
+
+
+class Profiler(object):
+    def __init__(self, python=None, directory="surpyvor_profile"):
+        if python == "pyinstrument":
+            try:
+                import pyinstrument  # noqa: F401
+            except ImportError:
+                sys.exit("ERROR: --profile-python pyinstrument requires pyinstrument.")
+        self.python = python
+        self.directory = directory
+        self.stages = []
+        self.running = []  # entries of the stages running, innermost last
+        self.depth = 0
+        self.resets_peak = reset_peak_rss()
+        self.started = time.perf_counter()
+        self.python_active = False
+        self.cprofiles = {}
+        self.pyinstrument_runs = {}
+
+    @contextmanager
+    def stage(self, name, python=False):
+        stage = Stage(name)
+        entry = {"stage": name, "depth": self.depth, "peak_rss_mb": None}
+        entry["children_peak_rss_mb"] = None
+        self.stages.append(entry)
+        self.update_peaks()
+        self.running.append(entry)
+        self.depth += 1
+        before = usage()
+        python_profiler = self.start_python(name) if python else None
+        try:
+            yield stage
+        finally:
+            if python_profiler:
+                self.stop_python(name, python_profiler)
+            after = usage()
+            self.update_peaks()
+            self.running.remove(entry)
+            self.depth -= 1
+            # without resetting, only a raised high-water mark is known to be of this stage
+            if not self.resets_peak and after["rss"] > before["rss"]:
+                entry["peak_rss_mb"] = after["rss"]
+            if after["children_rss"] > before["children_rss"]:
+                entry["children_peak_rss_mb"] = max_mb(
+                    entry["children_peak_rss_mb"], after["children_rss"]
+                )
+            entry.update(
+                start=round(before["wall"] - self.started, 4),
+                seconds=round(after["wall"] - before["wall"], 4),
+                records=stage.records,
+                cpu_seconds=round(after["cpu"] - before["cpu"], 4),
+                children_cpu_seconds=round(after["children_cpu"] - before["children_cpu"], 4),
+            )
+
+    def update_peaks(self):
+        """Account the peak memory since the last update to the running stages and reset it"""
+        if not self.resets_peak:
+            return
+        peak = read_peak_rss()
+        reset_peak_rss()
+        for entry in self.running:
+            entry["peak_rss_mb"] = max_mb(entry["peak_rss_mb"], peak)
+
+    def add_child(self, rusage):
+        """Account the peak memory of a finished subprocess to the running stages"""
+        for entry in self.running:
+            entry["children_peak_rss_mb"] = max_mb(
+                entry["children_peak_rss_mb"], rusage.ru_maxrss * RSS_SCALE
+            )
+
+    def start_python(self, name):
+        """Start profiling a Python stage, unless already profiling a stage around it"""
+        if not self.python or self.python_active:
+            return None
+        self.python_active = True
+        if self.python == "cprofile":
+            import cProfile
+
+            profiler = self.cprofiles.setdefault(name, cProfile.Profile())
+            profiler.enable()
+        else:
+            from pyinstrument import Profiler as Pyinstrument
+
+            profiler = Pyinstrument()
+            profiler.start()
+        return profiler
+
+    def stop_python(self, name, profiler):
+        self.python_active = False
+        if self.python == "cprofile":
+            profiler.disable()
+        else:
+            profiler.stop()
+            self.pyinstrument_runs.setdefault(name, []).append(profiler)
+
+    def write_python_profiles(self):
+        """Write a .prof file (cProfile) or .html files (pyinstrument) per Python stage"""
+        if not (self.cprofiles or self.pyinstrument_runs):
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        for name, profiler in self.cprofiles.items():
+            profiler.dump_stats(os.path.join(self.directory, file_name(name) + ".prof"))
+        for name, runs in self.pyinstrument_runs.items():
+            for number, profiler in enumerate(runs, start=1):
+                suffix = f".{number}.html" if len(runs) > 1 else ".html"
+                with open(os.path.join(self.directory, file_name(name) + suffix), "w") as out:
+                    out.write(profiler.output_html())
+        sys.stderr.write(f"Wrote Python profiles of the stages to {self.directory}\n")
+
+    def summary(self):
+        """Return the stages aggregated per name, in order of first appearance"""
+        stages = {}
+        for entry in self.stages:
+            if "seconds" not in entry:
+                continue  # still running, e.g. when reporting after an error
+            row = stages.setdefault(
+                entry["stage"],
+                {
+                    "stage": entry["stage"],
+                    "depth": entry["depth"],
+                    "calls": 0,
+                    "seconds": 0.0,
+                    "records": None,
+                    "cpu_seconds": 0.0,
+                    "children_cpu_seconds": 0.0,
+                    "peak_rss_mb": None,
+                    "children_peak_rss_mb": None,
+                },
+            )
+            row["calls"] += 1
+            for key in ["seconds", "cpu_seconds", "children_cpu_seconds"]:
+                row[key] = round(row[key] + entry[key], 4)
+            for key in ["peak_rss_mb", "children_peak_rss_mb"]:
+                row[key] = max_mb(row[key], entry[key])
+            if entry["records"] is not None:
+                row["records"] = (row["records"] or 0) + entry["records"]
+        return list(stages.values())
+
+    def table(self):
+        columns = ["calls", "seconds", "records", "records/s", "CPU s", "child CPU s"]
+        columns += ["peak RSS MB", "child peak RSS MB"]
+        widths = [max(len(c) + 2, 10) for c in columns]
+        lines = ["{:<36}".format("stage") + "".join(f"{c:>{w}}" for c, w in zip(columns, widths))]
+        for row in self.summary():
+            rate = row["records"] / row["seconds"] if row["records"] and row["seconds"] else None
+            values = [
+                row["calls"],
+                f"{row['seconds']:.3f}",
+                row["records"] if row["records"] is not None else "-",
+                f"{rate:.0f}" if rate else "-",
+                f"{row['cpu_seconds']:.3f}",
+                f"{row['children_cpu_seconds']:.3f}",
+                "-" if row["peak_rss_mb"] is None else f"{row['peak_rss_mb']:.1f}",
+                (
+                    "-"
+                    if row["children_peak_rss_mb"] is None
+                    else f"{row['children_peak_rss_mb']:.1f}"
+                ),
+            ]
+            name = "  " * row["depth"] + row["stage"]
+            lines.append(f"{name:<36}" + "".join(f"{v:>{w}}" for v, w in zip(values, widths)))
+        lines.append(f"total: {time.perf_counter() - self.started:.3f} seconds")
+        return "\n".join(lines) + "\n"
+
+    def report(self, output, command=None):
+        """Print the table on stderr for "-", write JSON for a .json file and a table otherwise"""
+        self.write_python_profiles()
+        if output == "-":
+            sys.stderr.write("\n" + self.table())
+        elif output.endswith(".json"):
+            with open(output, "w") as out:
+                json.dump(
+                    {
+                        "command": command,
+                        "seconds": round(time.perf_counter() - self.started, 4),
+                        "summary": self.summary(),
+                        "stages": self.stages,
+                    },
+                    out,
+                    indent=2,
+                )
+        else:
+            with open(output, "w") as out:
+                out.write(self.table())
+
+
+def usage():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        "wall": time.perf_counter(),
+        "cpu": own.ru_utime + own.ru_stime,
+        "children_cpu": children.ru_utime + children.ru_stime,
+        "rss": own.ru_maxrss * RSS_SCALE,
+        "children_rss": children.ru_maxrss * RSS_SCALE,
+    }
+
+
+def max_mb(peak, mb):
+    """Return the maximum of two peaks in MB, either of which can be None, rounded to 0.1"""
+    if mb is None:
+        return peak
+    return round(mb if peak is None else max(peak, mb), 1)
+
+
+def read_peak_rss():
+    """Return the peak resident memory (VmHWM) of this process in MB, or None if unknown"""
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    """Reset the peak resident memory of this process to the current one, if possible (Linux)"""
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        return False
+    return read_peak_rss() is not None
+
+
+def file_name(stage):
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", stage).strip("_")
+
+
+@contextmanager
+def profile(output=None, python=None, directory="surpyvor_profile", command=None):
+    """Profile the stages run within this context if output is set, and report to output"""
+    global PROFILER
+    if not output:
+        yield None
+        return
+    PROFILER = Profiler(python=python, directory=directory)
+    try:
+        with PROFILER.stage(command or "surpyvor"):
+            yield PROFILER
+    finally:
+        profiler, PROFILER = PROFILER, None
+        profiler.report(output, command=command)
+
+
+def stage(name, python=False):
+    """Return a context manager profiling the stage name, or doing nothing if not profiling
+
+    Set python for stages running Python code, to profile them with --profile-python.
+    """
+    if PROFILER is None:
+        return nullcontext(Stage(name))
+    return PROFILER.stage(name, python=python)
+
+
+def count(iterable, stage):
+    """Yield from iterable, counting the items as records of stage when profiling"""
+    if PROFILER is None:
+        return iterable
+    stage.records = stage.records or 0
+
+    def counted():
+        for item in iterable:
+            stage.records += 1
+            yield item
+
+    return counted()
+
+
+def call(args, **kwargs):
+    """Run args like subprocess.call, accounting the peak memory of the process when profiling"""
+    import subprocess
+
+    return wait(subprocess.Popen(args, **kwargs))
+
+
+def wait(process):
+    """Wait for a subprocess.Popen process like process.wait(), returning the exit code
+
+    When profiling, the process is reaped with os.wait4 to account its own peak memory to
+    the running stages, as RUSAGE_CHILDREN only has the peak of the largest child so far.
+    """
+    if PROFILER is None or process.returncode is not None:
+        return process.wait()
+    try:
+        _, status, rusage = os.wait4(process.pid, 0)
+    except ChildProcessError:  # already reaped
+        return process.wait()
+    process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    PROFILER.add_child(rusage)
+    return process.returncode
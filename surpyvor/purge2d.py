@@ -1,32 +1,160 @@
+import os
 import pysam
+import re
 import sys
-from cigar import Cigar
-import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from surpyvor import utils
 
+CIGAR_OPERATION = re.compile(r"(\d+)([MIDNSHP=X])")
 
-def process(bamfile, output="-", write_candidates=False):
-    twod = []
+
+def process(bamfile, output="-", write_candidates=False, threads=1):
+    """
+    Write the alignments of bamfile to output, without accidental 2D reads.
+
+    Every contig is processed as a separate shard, in <threads> worker processes if threads > 1.
+    Shards are written in the order of the contigs in the header, so the output stays sorted.
+    """
     bam = pysam.AlignmentFile(bamfile, "rb")
     mode = 'wb' if output.endswith('.bam') else 'w'
-    filtered_alignments = pysam.AlignmentFile(output, mode, template=bam)
-    for read in bam.fetch():
-        if is_accidental_2d(read):
-            twod.append(read)
-        else:
-            filtered_alignments.write(read)
-    sys.stderr.write(f"Detected {len(twod)} potential artefacts "
-                     f"out of {bam.mapped} alignments ({100*(len(twod))/bam.mapped}%)\n")
-    if write_candidates:
-        twod_bam = pysam.AlignmentFile("2D-candidates.bam", "wb", template=bam)
-        for r in twod:
-            twod_bam.write(r)
-    keep_these_candidates = follow_up_2d_candidates(twod, distance=500)
-    if keep_these_candidates:
+    if threads > 1:
+        with ProcessPoolExecutor(max_workers=threads) as pool:
+            shards = list(pool.map(purge_shard,
+                                   [bamfile] * bam.nreferences,
+                                   bam.references,
+                                   [write_candidates] * bam.nreferences))
+        combine_shards(bam, [s[0] for s in shards], output, mode)
+        if write_candidates:
+            combine_shards(bam, [s[1] for s in shards], "2D-candidates.bam", "wb")
+        counts = [s[2:] for s in shards]
+    else:
+        filtered_alignments = pysam.AlignmentFile(output, mode, template=bam)
+        twod_bam = pysam.AlignmentFile("2D-candidates.bam", "wb", template=bam) \
+            if write_candidates else None
+        counts = [purge_contig(bam, contig, filtered_alignments, twod_bam)
+                  for contig in bam.references]
+        filtered_alignments.close()
+        if twod_bam:
+            twod_bam.close()
+    twod = sum(c[0] for c in counts)
+    sys.stderr.write(f"Detected {twod} potential artefacts "
+                     f"out of {bam.mapped} alignments ({100*twod/max(bam.mapped, 1)}%)\n")
+    if any(c[1] for c in counts):
         sys.stderr.write("WARNING: Some potential artefacts are close to another.\n")
         sys.stderr.write("WARNING: As this could be an SV, these reads are kept.\n")
-        sys.stderr.write("WARNING: Surpyvor is producing an UNSORTED sam/bam.\n")
-        for read in keep_these_candidates:
-            filtered_alignments.write(read)
+
+
+def purge_shard(bamfile, contig, write_candidates=False):
+    """
+    Process a single contig in a worker process, writing to temporary bam files.
+    Returns the filtered bam, the candidates bam (or None) and the counts of purge_contig.
+    """
+    bam = pysam.AlignmentFile(bamfile, "rb")
+    shard = utils.temp_path(suffix=".bam")
+    candidates = utils.temp_path(suffix=".bam") if write_candidates else None
+    with pysam.AlignmentFile(shard, "wb", template=bam) as out:
+        if candidates:
+            with pysam.AlignmentFile(candidates, "wb", template=bam) as twod_bam:
+                counts = purge_contig(bam, contig, out, twod_bam)
+        else:
+            counts = purge_contig(bam, contig, out)
+    return (shard, candidates) + counts
+
+
+def purge_contig(bam, contig, out, twod_bam=None, distance=500, max_buffer=100000):
+    """
+    Write the alignments on contig to out, except for accidental 2D reads.
+
+    Candidate artefacts starting less than <distance> from the previous or next candidate
+    are kept, as these could be an SV. The contig is streamed once: a candidate is decided
+    when the next candidate or an alignment <distance> downstream is seen. While a candidate
+    is undecided the following alignments are held back in a ReadBuffer,
+    so that kept candidates are written in their original (sorted) position.
+    Returns the number of candidates and the number of candidates which are kept.
+    """
+    candidates = kept = 0
+    undecided = None  # candidate not close to the previous one, waiting for the next one
+    previous_start = None
+    buffer = ReadBuffer(template=bam, max_reads=max_buffer)
+    for read in bam.fetch(contig):
+        if undecided and read.reference_start - undecided.reference_start >= distance:
+            buffer.flush(out)
+            undecided = None
+        if not is_accidental_2d(read):
+            if undecided:
+                buffer.append(read)
+            else:
+                out.write(read)
+            continue
+        candidates += 1
+        if twod_bam:
+            twod_bam.write(read)
+        close = previous_start is not None and read.reference_start - previous_start < distance
+        previous_start = read.reference_start
+        if undecided:  # close to the undecided candidate, so both are kept
+            out.write(undecided)
+            buffer.flush(out)
+            out.write(read)
+            undecided = None
+            kept += 2
+        elif close:
+            out.write(read)
+            kept += 1
+        else:
+            undecided = read
+    buffer.flush(out)
+    return candidates, kept
+
+
+class ReadBuffer(object):
+    """
+    Alignments held back while a candidate artefact is undecided.
+    Above max_reads alignments the buffer is spilled to a temporary bam file,
+    so that memory use doesn't depend on the coverage.
+    """
+
+    def __init__(self, template, max_reads=100000):
+        self.template = template
+        self.max_reads = max_reads
+        self.reads = []
+        self.spill = None
+
+    def append(self, read):
+        self.reads.append(read)
+        if len(self.reads) >= self.max_reads:
+            if self.spill is None:
+                self.spill = pysam.AlignmentFile(utils.temp_path(suffix=".bam"), "wb",
+                                                 template=self.template)
+            for r in self.reads:
+                self.spill.write(r)
+            self.reads = []
+
+    def flush(self, out):
+        """Write all buffered alignments to out, in order, and empty the buffer"""
+        if self.spill is not None:
+            spilled = self.spill.filename.decode()
+            self.spill.close()
+            with pysam.AlignmentFile(spilled, "rb") as spill:
+                for read in spill.fetch(until_eof=True):
+                    out.write(read)
+            os.remove(spilled)
+            self.spill = None
+        for read in self.reads:
+            out.write(read)
+        self.reads = []
+
+
+def combine_shards(bam, shards, output, mode):
+    """Write the alignments of the shards to output, in order"""
+    if mode == "wb":
+        pysam.cat("-o", output, *shards)
+        return
+    with pysam.AlignmentFile(output, mode, template=bam) as out:
+        for shard in shards:
+            with pysam.AlignmentFile(shard, "rb") as shard_bam:
+                for read in shard_bam.fetch(until_eof=True):
+                    out.write(read)
 
 
 def get_sa_attributes(sa_tag):
@@ -36,11 +164,20 @@ def get_sa_attributes(sa_tag):
     '''
     sasplit = sa_tag.split(',')
     start = int(sasplit[1])
-    end = start + Cigar(sasplit[3]).reference_length()
+    end = start + reference_length(sasplit[3])
     strand = sasplit[2]
     return start, end, strand
 
 
+@lru_cache(maxsize=65536)
+def reference_length(cigar):
+    """
+    Return the number of reference bases covered by a CIGAR string: the sum of M, D, N, = and X
+    Long reads often share the CIGAR of their supplementary alignments, so results are cached.
+    """
+    return sum(int(length) for length, op in CIGAR_OPERATION.findall(cigar) if op in "MDN=X")
+
+
 def get_strand(read):
     return '-' if read.is_reverse else '+'
 
@@ -58,7 +195,7 @@ def is_accidental_2d(read):
     Return True for supplementary alignments for which a single other (the primary) alignment exists
     for which the strand is reverse and the reference span is overlapping
     """
-    if read.has_tag('SA') and read.is_supplementary:
+    if read.is_supplementary and read.has_tag('SA'):
         supps = [get_sa_attributes(s) for s in read.get_tag('SA').split(';') if s]
         if len(supps) > 1:
             return False
@@ -69,30 +206,3 @@ def is_accidental_2d(read):
             return False
     else:
         return False
-
-
-def follow_up_2d_candidates(candidates, distance=500):
-    df = pd.DataFrame.from_records(
-        data=[(r.query_name, r.reference_name, r.reference_start, r.reference_end)
-              for r in candidates],
-        columns=["RNAME", "Chromosome", "Start", "End"])
-    keep_these_reads = []
-    for chrom in df["Chromosome"].unique():
-        keep_these_reads.extend(
-            follow_up_2d_candidates_per_chrom(
-                df[df["Chromosome"] == chrom].sort_values(by=["Start", "End"]),
-                distance=distance)
-        )
-    return [r for r in candidates if r.query_name in keep_these_reads]
-
-
-def follow_up_2d_candidates_per_chrom(df, distance=500):
-    """
-    Per chromosome, calculate the minimum of the distance with the previous and next read
-    Distances are calculated based on read start position.
-    Return only those read identifiers that are <= <distance> from each other.
-    """
-    df["distance"] = pd.concat([df["Start"].diff().abs(),
-                                df["Start"].diff(periods=-1).abs()],
-                               axis="columns").min(axis='columns')
-    return df.loc[df["distance"] < distance, "RNAME"].to_list()
@@ -0,0 +1,110 @@
+"""
+Sidecar files with the SV summary data of a vcf, for repeated plotting and statistics.
+
+`surpyvor index` writes the GenotypeMatrix of a vcf (chromosome, start, end, SVTYPE, SVLEN
+and genotypes) next to it as <vcf>.surpyvor.npz, with genotypes packed in 2 bits.
+utils.genotype_matrix loads the sidecar instead of parsing the vcf, as long as the
+modification time and size of the vcf are unchanged.
+"""
+
+import os
+import sys
+import tempfile
+import numpy as np
+from surpyvor import profiling
+
+SUFFIX = ".surpyvor.npz"
+VERSION = 1
+
+
+def sidecar_path(vcf):
+    return vcf + SUFFIX
+
+
+def index(vcf):
+    """Parse vcf and write its sidecar file, returning the path"""
+    from surpyvor import utils
+
+    return write(vcf, utils.genotype_matrix(vcf, use_index=False))
+
+
+def write(vcf, gm):
+    """Write the GenotypeMatrix gm of vcf to the sidecar file of vcf"""
+    stat = os.stat(vcf)
+    path = sidecar_path(vcf)
+    handle, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    with profiling.stage("write sidecar"), os.fdopen(handle, "wb") as out:
+        np.savez(
+            out,
+            version=VERSION,
+            mtime=stat.st_mtime_ns,
+            size=stat.st_size,
+            samples=np.array(gm.samples, dtype=str),
+            chroms=np.array(gm.chroms, dtype=str),
+            svtypes=np.array(["" if t is None else t for t in gm.svtypes], dtype=str),
+            chrom=gm.chrom,
+            pos=gm.pos,
+            end=gm.end,
+            svtype=gm.svtype,
+            svlen=gm.svlen,
+            gt=pack_genotypes(gm.gt),
+        )
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tmp, 0o666 & ~umask)
+    os.replace(tmp, path)
+    return path
+
+
+def load(vcf, samples=None):
+    """Return the GenotypeMatrix of vcf from its sidecar file, or None if absent or stale
+
+    If samples is a list of sample names, only these samples are kept, in the order of the vcf.
+    """
+    from surpyvor.utils import GenotypeMatrix
+
+    path = sidecar_path(vcf)
+    if not os.path.isfile(path):
+        return None
+    stat = os.stat(vcf)
+    with profiling.stage("load sidecar") as stage, np.load(path) as data:
+        if (
+            int(data["version"]) != VERSION
+            or int(data["mtime"]) != stat.st_mtime_ns
+            or int(data["size"]) != stat.st_size
+        ):
+            return None
+        names = data["samples"].tolist()
+        gt = unpack_genotypes(data["gt"], len(names))
+        if samples:
+            missing = [s for s in samples if s not in names]
+            if missing:
+                sys.exit("ERROR: samples not found in {}: {}".format(vcf, ", ".join(missing)))
+            columns = [i for i, name in enumerate(names) if name in samples]
+            names, gt = [names[i] for i in columns], gt[:, columns]
+        stage.records = len(gt)
+        return GenotypeMatrix(
+            samples=names,
+            chroms=data["chroms"].tolist(),
+            chrom=data["chrom"],
+            pos=data["pos"],
+            end=data["end"],
+            svtypes=[t or None for t in data["svtypes"].tolist()],
+            svtype=data["svtype"],
+            svlen=data["svlen"],
+            gt=gt,
+        )
+
+
+def pack_genotypes(gt):
+    """Pack a uint8 matrix of gt_types (values 0 to 3) in 2 bits per genotype"""
+    padded = np.zeros((gt.shape[0], -(-gt.shape[1] // 4) * 4), dtype=np.uint8)
+    padded[:, : gt.shape[1]] = gt
+    return padded[:, 0::4] | padded[:, 1::4] << 2 | padded[:, 2::4] << 4 | padded[:, 3::4] << 6
+
+
+def unpack_genotypes(packed, num_samples):
+    gt = np.empty((packed.shape[0], packed.shape[1] * 4), dtype=np.uint8)
+    for i in range(4):
+        gt[:, i::4] = (packed >> (2 * i)) & 3
+    return gt[:, :num_samples]
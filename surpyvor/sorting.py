@@ -0,0 +1,157 @@
+"""
+Sorting vcf files by coordinate in-process, with a bounded number of records in memory.
+
+Records are sorted by the order of the contigs in the header (contigs absent from the header
+follow in order of appearance) and position, keeping the input order of records at the same
+position. The sorted start of the input is passed through as the first run, so sorted input
+is never sorted. From the first record out of order the remainder is read in chunks, which
+are sorted and spilled to gzip-compressed runs, and the runs are merged with a k-way merge.
+sorted_lines can be used on its own as a streaming stage, e.g. on the output of a transform.
+"""
+
+import gzip
+import heapq
+import os
+import sys
+from contextlib import contextmanager
+from operator import itemgetter
+from surpyvor import profiling, utils
+
+# records held in memory, per chunk and for the first run before it is spilled
+MAX_RECORDS = 200000
+
+
+def sort_vcf(input, output, max_records=MAX_RECORDS):
+    """Sort the vcf file input to output, which can be a fifo
+
+    Output ending in .gz or .bgz is compressed and indexed, "stdout" or "-" writes to stdout.
+    """
+    with profiling.stage("sort", python=True) as stage, open_text(input) as lines:
+        header = read_header(lines)
+        if not header or not header[-1].startswith("#CHROM"):
+            sys.exit(f"ERROR: no vcf header found in {input}, can't sort it.")
+        key = record_key(contig_rank(header))
+        # skip empty lines and make sure a last line without newline isn't joined to another
+        records = (line if line.endswith("\n") else line + "\n" for line in lines if line != "\n")
+        with utils.open_output(output) as out:
+            out.writelines(header)
+            out.writelines(profiling.count(sorted_lines(records, key, max_records), stage))
+
+
+@contextmanager
+def open_text(vcf):
+    """Open a plain or (b)gzip-compressed vcf as text"""
+    if utils.is_compressed(vcf):
+        with gzip.open(vcf, "rt") as lines:
+            yield lines
+    else:
+        with open(vcf) as lines:
+            yield lines
+
+
+def read_header(lines):
+    """Return the header lines, consuming lines up to and including the #CHROM line"""
+    header = []
+    for line in lines:
+        header.append(line)
+        if line.startswith("#CHROM"):
+            break
+    return header
+
+
+def contig_rank(header):
+    """Return a dict with the rank of every contig in the header lines"""
+    contigs = [
+        line.split("ID=", 1)[1].split(",", 1)[0].rstrip(">\n")
+        for line in header
+        if line.startswith("##contig=<")
+    ]
+    return {c: i for i, c in enumerate(dict.fromkeys(contigs))}
+
+
+def record_key(rank):
+    """Return a function giving the (contig rank, position) of a vcf line
+
+    Contigs absent from rank are added to it in order of appearance.
+    """
+
+    def key(line):
+        chrom, pos, _ = line.split("\t", 2)
+        return rank.setdefault(chrom, len(rank)), int(pos)
+
+    return key
+
+
+def sorted_lines(lines, key, max_records=MAX_RECORDS):
+    """Yield lines sorted on key, with at most max_records lines in memory
+
+    Lines with an equal key are yielded in input order. Temporary runs are removed when done.
+    """
+    lines = iter(lines)
+    first, last = [], None
+    first_run = None
+    for line in lines:
+        current = key(line)
+        if last is not None and current < last:
+            break
+        last = current
+        first.append(line)
+        if len(first) >= max_records:
+            first_run = first_run or Run()
+            first_run.write(first)
+            first = []
+    else:  # sorted input: nothing left to sort
+        if first_run:
+            yield from first_run.read()
+            first_run.remove()
+        yield from first
+        return
+    runs = [first_run] if first_run else []
+    if first:
+        runs.append(Run(first))
+    chunk = [(current, line)]
+    for line in lines:
+        chunk.append((key(line), line))
+        if len(chunk) >= max_records:
+            chunk.sort(key=itemgetter(0))
+            runs.append(Run(line for _, line in chunk))
+            chunk = []
+    chunk.sort(key=itemgetter(0))
+    with profiling.stage("merge sorted runs"):
+        try:
+            # heapq.merge is stable: on ties, runs earlier in the input come first
+            merged = heapq.merge(
+                *[((key(line), line) for line in run.read()) for run in runs],
+                chunk,
+                key=itemgetter(0),
+            )
+            for _, line in merged:
+                yield line
+        finally:
+            for run in runs:
+                run.remove()
+
+
+class Run(object):
+    """A sorted run of lines spilled to a temporary gzip-compressed file"""
+
+    def __init__(self, lines=None):
+        self.path = utils.temp_path(suffix=".run.gz")
+        if lines is not None:
+            self.write(lines)
+
+    def write(self, lines):
+        with profiling.stage("spill sorted run"), gzip.open(
+            self.path, "at", compresslevel=1
+        ) as out:
+            out.writelines(lines)
+
+    def read(self):
+        with gzip.open(self.path, "rt") as lines:
+            yield from lines
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
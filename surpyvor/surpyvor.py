@@ -1,10 +1,27 @@
-from surpyvor import utils, parse_arguments
+from surpyvor import utils, parse_arguments, profiling
+import os
 import sys
 
 
 def main():
     args = parse_arguments.get_args()
-    utils.test_dependencies()
+    utils.test_dependencies(required_executables(args))
+    with utils.scratch_space(args.tmpdir):
+        run(args)
+
+
+def run(args):
+    utils.IO_THREADS = args.io_threads
+    with profiling.profile(
+        args.profile,
+        python=args.profile_python,
+        directory=args.profile_dir,
+        command=args.command,
+    ):
+        run_command(args)
+
+
+def run_command(args):
     if args.command == "merge":
         sv_merge(
             samples=args.variants,
@@ -16,10 +33,12 @@ def main():
             minlength=args.minlength,
             output=args.output,
             verbose=args.verbose,
+            engine=args.engine,
+            threads=args.threads,
         )
     elif args.command == "highsens":
         sv_merge(
-            samples=[utils.vcf_concat(args.variants)],
+            samples=args.variants,
             distance=args.distance,
             callers=1,
             require_type=True,
@@ -28,6 +47,9 @@ def main():
             minlength=args.minlength,
             output=args.output,
             verbose=args.verbose,
+            engine=args.engine,
+            threads=args.threads,
+            pool_samples=True,
         )
     elif args.command == "highconf":
         sv_merge(
@@ -40,6 +62,8 @@ def main():
             minlength=args.minlength,
             output=args.output,
             verbose=args.verbose,
+            engine=args.engine,
+            threads=args.threads,
         )
     elif args.command == "prf":
         precision_recall_fmeasure(args)
@@ -56,21 +80,79 @@ def main():
     elif args.command == "svlentruncate":
         svlentruncate(args)
     elif args.command == "fixvcf":
-        utils.fix_vcf(args.vcf, args.output, args.fai, jasmine=args.jasmine)
+        utils.fix_vcf(
+            args.vcf,
+            args.output,
+            args.fai,
+            jasmine=args.jasmine,
+            threads=args.threads,
+            **selection(args),
+        )
     elif args.command == "purge2d":
         purge2d(args)
     elif args.command == "carrierplot":
         from surpyvor.plots import carrierplot
 
-        carrierplot(args)
+        with profiling.stage("carrierplot", python=True):
+            carrierplot(args, **selection(args))
     elif args.command == "varcount":
         from surpyvor.plots import num_variants_per_sample
 
-        num_variants_per_sample(args.variants, args.plotout, args.countsout)
+        with profiling.stage("varcount", python=True):
+            num_variants_per_sample(args.variants, args.plotout, args.countsout, **selection(args))
+    elif args.command == "batch":
+        from surpyvor.batch import batch
+
+        batch(
+            args.manifest,
+            jobs=args.jobs,
+            command=args.batch_command,
+            report_file=args.report,
+            verbose=args.verbose,
+        )
+    elif args.command == "index":
+        from surpyvor import sidecar
+
+        for vcf in args.variants:
+            print(sidecar.index(vcf), file=sys.stderr)
+    elif args.command == "sort":
+        utils.vcf_sort(args.vcf, args.output, max_records=args.max_records)
     elif args.command == "fixref":
         from surpyvor.fixref import fixref
 
-        fixref(args.variants, args.fasta)
+        with profiling.stage("fixref", python=True):
+            fixref(
+                args.variants,
+                args.fasta,
+                output=args.output,
+                max_ref_len=args.max_ref_len,
+                **selection(args),
+            )
+
+
+def required_executables(args):
+    """Return the external tools that the sub-command uses with these arguments"""
+    tools = set()
+    snv = args.snv and args.command in ["prf", "upset", "venn"]
+    if args.command in ["merge", "highsens", "highconf", "prf", "upset", "venn", "haplomerge"]:
+        if snv:
+            tools.add("bcftools")
+        elif args.engine == "survivor":
+            tools.update(["SURVIVOR", "bgzip", "tabix"])
+    # for compressing and indexing input or output vcf files:
+    # the input is split per contig with --threads, haplomerge --samples-file writes .vcf.gz
+    sharded = ["merge", "highsens", "highconf", "prf", "upset", "venn"]
+    sharded += ["minlen", "svlentruncate", "fixvcf"]
+    if args.command in sharded and getattr(args, "threads", 1) > 1 and not snv:
+        tools.update(["bgzip", "tabix"])
+    if getattr(args, "samples_file", None):
+        tools.update(["bgzip", "tabix"])
+    if getattr(args, "region", None) or getattr(args, "regions_file", None):
+        tools.update(["bgzip", "tabix"])
+    for output in [getattr(args, "output", None), getattr(args, "keepmerged", None)]:
+        if output and utils.is_compressed(output):
+            tools.update(["bgzip", "tabix"])
+    return sorted(tools)
 
 
 def sv_merge(
@@ -83,9 +165,14 @@ def sv_merge(
     minlength,
     output,
     verbose=False,
+    engine="survivor",
+    pool_samples=False,
+    threads=1,
+    svtype_map=None,
+    quiet=False,
 ):
     """
-    Executes SURVIVOR merge, with parameters:
+    Executes SURVIVOR merge, or the native merge engine if engine == "native", with parameters:
     -samples.fofn (samples, list)
     -distance between calls (distance, int)
     -number of callers to support call (callers, int)
@@ -93,17 +180,69 @@ def sv_merge(
     -require variants to be on same strand (strand, boolean)
     -estimate distance between calls (estimate_distance, boolean)
     -specify minimal size of SV event (minlength, int)
+    -treat all vcf files as the same sample (pool_samples, boolean)
+    -number of processes to merge chromosomes in parallel (threads, int)
+    -rename SV types while reading, e.g. utils.DUP_TO_INS (svtype_map, dict)
+    -don't print progress, e.g. when merging a shard in a worker process (quiet, boolean)
     """
+    if threads > 1:
+        from surpyvor.parallel import sharded_merge
+
+        with profiling.stage(f"merge ({threads} processes)"):
+            sharded_merge(
+                samples=samples,
+                output=output,
+                threads=threads,
+                distance=distance,
+                callers=callers,
+                require_type=require_type,
+                require_strand=require_strand,
+                estimate_distance=estimate_distance,
+                minlength=minlength,
+                engine=engine,
+                pool_samples=pool_samples,
+                svtype_map=svtype_map,
+            )
+        return
+    if engine == "native":
+        from surpyvor.nativemerge import merge_vcfs
+
+        if verbose:
+            print("\n\nMerging with the native engine.", file=sys.stderr)
+        if not quiet:
+            print("Executing native merge...", end="", flush=True, file=sys.stderr)
+        with profiling.stage("native merge", python=True):
+            merge_vcfs(
+                vcffiles=samples,
+                output=output,
+                distance=distance,
+                callers=callers,
+                require_type=require_type,
+                require_strand=require_strand,
+                estimate_distance=estimate_distance,
+                minlength=minlength,
+                pool_samples=pool_samples,
+                svtype_map=svtype_map,
+                verbose=verbose,
+            )
+        if not quiet:
+            print("DONE", file=sys.stderr)
+        return
     import subprocess
     import shlex
-    import os
-    import tempfile
+    import threading
+    import time
 
-    fhf, fofn_f = tempfile.mkstemp()
-    fhs, interm_out = tempfile.mkstemp(suffix=".vcf")
+    if pool_samples:
+        samples = [utils.vcf_concat(samples)]
+    fofn_f = utils.temp_path()
     with open(fofn_f, "w") as fofn:
-        for s in [utils.decompress(s) for s in samples]:
+        for s in samples:
+            # SURVIVOR requires uncompressed input, so renaming types doesn't cost an extra copy
+            s = utils.normalize_vcf(s, svtype_map) if svtype_map else utils.decompress(s)
             fofn.write(s + "\n")
+    # SURVIVOR writes to a named pipe from which the output is sorted, avoiding an intermediate file
+    interm_out = utils.temp_fifo(suffix=".vcf")
     survivor_cmd = "SURVIVOR merge {fof} {dist} {call} {typ} {str} {estm} {ml} {out}".format(
         fof=fofn_f,
         dist=distance,
@@ -117,14 +256,39 @@ def sv_merge(
     if verbose:
         print("\n\nExecuting:", file=sys.stderr)
         print(survivor_cmd, file=sys.stderr)
-    print("Executing SURVIVOR...", end="", flush=True, file=sys.stderr)
-    subprocess.call(shlex.split(survivor_cmd), stdout=subprocess.DEVNULL)
-    print("DONE", file=sys.stderr)
-    if verbose:
-        print("\n\nSorting merged vcf file:", file=sys.stderr)
-    utils.vcf_sort(interm_out, output)
-    os.close(fhf)
-    os.close(fhs)
+        print("\n\nSorting merged vcf file while merging", file=sys.stderr)
+    if not quiet:
+        print("Executing SURVIVOR...", end="", flush=True, file=sys.stderr)
+    with profiling.stage("SURVIVOR merge | sort"):
+        survivor = subprocess.Popen(shlex.split(survivor_cmd), stdout=subprocess.DEVNULL)
+        sorted_ = threading.Event()
+
+        def release():
+            # if SURVIVOR exits without opening the pipe, the sorter may not have opened it yet
+            # either, so retry until the sorter is waiting on it or done
+            profiling.wait(survivor)
+            while not sorted_.is_set() and not utils.release_fifo(interm_out):
+                time.sleep(0.05)
+
+        def finish():
+            sorted_.set()
+            watcher.join()
+            if survivor.returncode != 0:
+                sys.exit(f"ERROR: SURVIVOR failed (exit {survivor.returncode})")
+
+        watcher = threading.Thread(target=release)
+        watcher.start()
+        try:
+            utils.vcf_sort(interm_out, output)
+        except SystemExit:
+            finish()  # the sorter fails on the empty or truncated output of a failing SURVIVOR
+            raise
+        except BaseException:
+            sorted_.set()
+            raise
+        finish()
+    if not quiet:
+        print("DONE", file=sys.stderr)
 
 
 def snv_merge(samples, output, verbose=False):
@@ -132,27 +296,47 @@ def snv_merge(samples, output, verbose=False):
     import shlex
 
     inputfiles = " ".join(samples)
-    bcftools_cmd = f"bcftools merge {inputfiles} -o {output}"
+    bcftools_cmd = f"bcftools merge --threads {utils.IO_THREADS} {inputfiles} -o {output}"
     if verbose:
         print("\n\nExecuting:", file=sys.stderr)
         print(bcftools_cmd, file=sys.stderr)
     print("Executing bcftools...", end="", flush=True, file=sys.stderr)
-    subprocess.call(shlex.split(bcftools_cmd), stdout=subprocess.DEVNULL)
+    with profiling.stage("bcftools merge"):
+        profiling.call(shlex.split(bcftools_cmd), stdout=subprocess.DEVNULL)
     print("DONE", file=sys.stderr)
 
 
 def default_merge(args, variants):
-    import tempfile
+    from surpyvor import cache
 
+    if not args.no_cache:
+        key = cache.merge_key(
+            variants,
+            snv=args.snv,
+            distance=args.distance,
+            minlength=args.minlength,
+            ignore_type=args.ignore_type,
+            strand=False,
+            engine=args.engine,
+        )
+        cached = cache.lookup(key, directory=args.cache_dir)
+        if cached:
+            if args.verbose:
+                print(f"\n\nUsing cached merged vcf {cached}", file=sys.stderr)
+            if args.keepmerged:
+                import shutil
+
+                shutil.copyfile(cached, args.keepmerged)
+            return cached
     if args.keepmerged:
         vcf_out = args.keepmerged
     else:
-        _, vcf_out = tempfile.mkstemp()
+        vcf_out = utils.temp_path(suffix=".vcf")
     if args.snv:
         snv_merge(samples=variants, output=vcf_out, verbose=args.verbose)
     else:
         sv_merge(
-            samples=[utils.normalize_vcf(s) for s in variants],
+            samples=variants,
             distance=args.distance,
             callers=1,
             require_type=not args.ignore_type,
@@ -161,42 +345,100 @@ def default_merge(args, variants):
             minlength=args.minlength,
             output=vcf_out,
             verbose=args.verbose,
+            engine=args.engine,
+            threads=args.threads,
+            svtype_map=utils.DUP_TO_INS,
         )
+    if not args.no_cache:
+        with profiling.stage("cache store"):
+            cached = cache.store(
+                key, vcf_out, directory=args.cache_dir, max_size=args.cache_size * 1e6
+            )
+        if os.path.isfile(cached):
+            return cached  # so that a sidecar file is stored next to the cached vcf
     return vcf_out
 
 
 def precision_recall_fmeasure(args):
-    vcf_out = default_merge(args, variants=[args.truth, args.test])
-    truth_set, test_set = utils.get_variant_identifiers(
-        vcf=vcf_out, ignore_chroms=args.ignore_chroms
+    """
+    Merge all truth and test sets once and calculate precision, recall and F-measure
+    for every combination of a truth and a test set, optionally stratified by SVTYPE and SVLEN
+    """
+    vcf_out = default_merge(args, variants=args.truth + args.test)
+    gm = utils.genotype_matrix(vcf_out, store_index=not args.no_cache)
+    keys = utils.get_variant_identifiers(
+        vcf=gm, ignore_chroms=args.ignore_chroms, num_samples=len(gm.samples)
     )
+    truth_sets, test_sets = keys[: len(args.truth)], keys[len(args.truth) :]
 
-    tp = len(truth_set & test_set)
-    precision = tp / len(test_set)
-    print(f"Precision: {round(precision, ndigits=4)}")
-    recall = tp / len(truth_set)
-    print(f"Recall: {round(recall, ndigits=4)}")
-    fmeasure = 2 * (precision * recall) / (precision + recall)
-    print(f"F-measure: {round(fmeasure, ndigits=4)}")
+    if len(args.truth) == 1 and len(args.test) == 1 and not args.stratify:
+        _, precision, recall, fmeasure = prf(truth_sets[0], test_sets[0])
+        print(f"Precision: {round(precision, ndigits=4)}")
+        print(f"Recall: {round(recall, ndigits=4)}")
+        print(f"F-measure: {round(fmeasure, ndigits=4)}")
+    else:
+        print(
+            "truth\ttest\tstratum\ttruth_variants\ttest_variants\ttp\tprecision\trecall\tF-measure"
+        )
+        strata = [("all", truth_sets, test_sets)]
+        if args.stratify:
+            labels = utils.get_strata(gm)
+            for label in sorted(set(labels.tolist())):
+                stratum = utils.get_variant_identifiers(
+                    vcf=gm,
+                    ignore_chroms=args.ignore_chroms,
+                    num_samples=len(gm.samples),
+                    rows=labels == label,
+                )
+                strata.append((label, stratum[: len(args.truth)], stratum[len(args.truth) :]))
+        for label, truths, tests in strata:
+            for truth_name, truth_set in zip(args.truth, truths):
+                for test_name, test_set in zip(args.test, tests):
+                    tp, precision, recall, fmeasure = prf(truth_set, test_set)
+                    print(
+                        f"{truth_name}\t{test_name}\t{label}\t{truth_set.size}\t{test_set.size}\t"
+                        f"{tp}\t{precision:.4f}\t{recall:.4f}\t{fmeasure:.4f}"
+                    )
 
     if args.venn:
         from surpyvor.plots import venn_diagram
 
-        venn_diagram((truth_set, test_set), labels=("Truth", "Test"))
+        with profiling.stage("venn plot", python=True):
+            venn_diagram((truth_sets[0], test_sets[0]), labels=("Truth", "Test"))
     if args.bar:
         from surpyvor.plots import bar_chart
 
-        bar_chart(vcf_out)
+        with profiling.stage("bar chart", python=True):
+            bar_chart(vcf_out)
     if args.matrix:
-        utils.confusion_matrix(vcf_out, names=["truth", "test"])
+        with profiling.stage("confusion matrix", python=True):
+            utils.confusion_matrix(vcf_out, names=["truth", "test"])
+
+
+def prf(truth_set, test_set):
+    """Return true positives, precision, recall and F-measure of two arrays of variant keys"""
+    import numpy as np
+
+    tp = np.intersect1d(truth_set, test_set, assume_unique=True).size
+    precision = tp / test_set.size if test_set.size else 0.0
+    recall = tp / truth_set.size if truth_set.size else 0.0
+    fmeasure = 2 * (precision * recall) / (precision + recall) if tp else 0.0
+    return tp, precision, recall, fmeasure
 
 
 def upset(args):
     from surpyvor.plots import upset_plot
 
     vcf_out = default_merge(args, args.variants)
-    upsets = utils.make_sets(vcf=vcf_out, names=args.names or args.variants)
-    upset_plot(upsets, outname=args.plotout)
+    upsets = utils.make_sets(
+        vcf=utils.genotype_matrix(vcf_out, store_index=not args.no_cache),
+        names=args.names or args.variants,
+        max_intersections=args.max_intersections,
+    )
+    if args.countsout:
+        utils.write_sets(upsets, output=args.countsout)
+    with profiling.stage("upset plot", python=True):
+        upset_plot(upsets, outname=args.plotout)
 
 
 def venn(args):
@@ -204,47 +446,102 @@ def venn(args):
 
     vcf_out = default_merge(args, args.variants)
     sets = utils.get_variant_identifiers(
-        vcf=vcf_out, ignore_chroms=[], num_samples=len(args.variants)
-    )
-    venn_diagram(
-        sets,
-        labels=args.names or args.variants,
+        vcf=utils.genotype_matrix(vcf_out, store_index=not args.no_cache),
+        ignore_chroms=[],
         num_samples=len(args.variants),
-        outname=args.plotout,
     )
+    with profiling.stage("venn plot", python=True):
+        venn_diagram(
+            sets,
+            labels=args.names or args.variants,
+            num_samples=len(args.variants),
+            outname=args.plotout,
+        )
 
 
 def haplomerge(args):
     from surpyvor import haplomerge as hm
 
-    args.keepmerged = False
-    merged = default_merge(args, args.variants)
-    hm.merge_split_called_haplotypes(merged, output=args.output, name=args.name)
+    if args.engine == "native":
+        merge_kwargs = dict(
+            distance=args.distance,
+            minlength=args.minlength,
+            require_type=not args.ignore_type,
+            require_strand=args.strand,
+            estimate_distance=args.estimate_distance,
+            svtype_map=utils.DUP_TO_INS,
+        )
+        if args.samples_file:
+            with profiling.stage(f"haplomerge ({args.threads} processes)"):
+                outputs = hm.merge_samples(
+                    hm.read_samples_file(args.samples_file),
+                    outdir=args.outdir,
+                    threads=args.threads,
+                    **merge_kwargs,
+                )
+            if args.verbose:
+                sys.stderr.write(f"Wrote {len(outputs)} phased vcf files to {args.outdir}.\n")
+        else:
+            with profiling.stage("haplomerge", python=True):
+                hm.merge_haplotypes(
+                    args.variants, output=args.output, name=args.name, **merge_kwargs
+                )
+    else:
+        args.keepmerged = False
+        merged = default_merge(args, args.variants)
+        with profiling.stage("haplomerge", python=True):
+            hm.merge_split_called_haplotypes(merged, output=args.output, name=args.name)
 
 
 def purge2d(args):
     from surpyvor import purge2d as p2d
 
-    p2d.process(args.bam, output=args.output)
+    with profiling.stage("purge2d", python=True):
+        p2d.process(args.bam, output=args.output, threads=args.threads)
 
 
 def lengthplot(args):
     from surpyvor.plots import length_plot
 
-    len_dict = utils.get_svlengths(args.vcf, all=args.all)
+    with profiling.stage("get_svlengths", python=True) as stage:
+        histogram = utils.get_svlengths(args.vcf, all=args.all, **selection(args))
+        stage.records = sum(histogram.number.values())
     with open(args.counts, "w") as counts:
         counts.write("Number of nucleotides affected by SV:\n")
-        for svtype, lengths in len_dict.items():
-            counts.write("{}:\t{} variants\t{}bp\n".format(svtype, len(lengths), sum(lengths)))
-    length_plot(dict_of_lengths=len_dict, output=args.plotout)
+        for svtype, number in histogram.number.items():
+            counts.write("{}:\t{} variants\t{}bp\n".format(svtype, number, histogram.total[svtype]))
+    with profiling.stage("length plot", python=True):
+        length_plot(histogram=histogram, output=args.plotout)
 
 
 def minlen(args):
-    utils.filter_vcf(args.vcf, output=args.output, minlength=args.length, suffix="filtered")
+    utils.filter_vcf(
+        args.vcf,
+        output=args.output,
+        minlength=args.length,
+        suffix="filtered",
+        threads=args.threads,
+        **selection(args),
+    )
+
+
+def selection(args):
+    """Return the regions and samples to restrict single-vcf sub-commands to"""
+    return {
+        "regions": utils.get_regions(args.region, args.regions_file),
+        "samples": args.samples.split(",") if args.samples else None,
+    }
 
 
 def svlentruncate(args):
-    utils.filter_vcf(args.vcf, output=args.output, truncate_svlen=args.length, suffix="truncated")
+    utils.filter_vcf(
+        args.vcf,
+        output=args.output,
+        truncate_svlen=args.length,
+        suffix="truncated",
+        threads=args.threads,
+        **selection(args),
+    )
 
 
 if __name__ == "__main__":
@@ -1,10 +1,211 @@
 import os
 import sys
 import tempfile
-from cyvcf2 import VCF, Writer
 import subprocess
 import shlex
-import pandas as pd
+from collections import namedtuple
+from contextlib import contextmanager
+from functools import partial
+from surpyvor import profiling
+
+# number of htslib/bgzip threads for reading and writing compressed vcf files, see --io-threads
+IO_THREADS = 1
+
+
+@contextmanager
+def scratch_space(tmpdir=None):
+    """Create a scratch directory for all intermediate files, removed on exit or error
+
+    Temporary files of surpyvor, and of the tools and processes it starts,
+    are created in this directory by setting tempfile.tempdir and $TMPDIR.
+    """
+    import shutil
+    import signal
+
+    directory = tempfile.mkdtemp(prefix="surpyvor_", dir=tmpdir)
+    previous = tempfile.tempdir, os.environ.get("TMPDIR")
+    tempfile.tempdir = os.environ["TMPDIR"] = directory
+    # make sure a SIGTERM also results in cleaning up
+    handler = signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    try:
+        yield directory
+    finally:
+        signal.signal(signal.SIGTERM, handler)
+        tempfile.tempdir = previous[0]
+        if previous[1] is None:
+            del os.environ["TMPDIR"]
+        else:
+            os.environ["TMPDIR"] = previous[1]
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def temp_path(suffix=""):
+    """Return the path of a new empty temporary file, without keeping it open"""
+    handle, name = tempfile.mkstemp(suffix=suffix)
+    os.close(handle)
+    return name
+
+
+def temp_fifo(suffix=""):
+    """Return the path of a new named pipe, to stream between processes without a file"""
+    name = os.path.join(tempfile.mkdtemp(), "pipe" + suffix)
+    os.mkfifo(name)
+    return name
+
+
+def release_fifo(name):
+    """Unblock a reader waiting on fifo name, e.g. if the writer failed to open it
+
+    Returns False if no reader has the fifo open (yet), so nothing was released.
+    """
+    try:
+        os.close(os.open(name, os.O_WRONLY | os.O_NONBLOCK))
+    except OSError:  # ENXIO: no reader
+        return False
+    return True
+
+
+def open_vcf(vcf, regions=None, samples=None, **kwargs):
+    """Open a vcf file with cyvcf2, decompressing with IO_THREADS threads
+
+    If samples is a list of sample names, only these samples are parsed.
+    Querying regions requires an index, so if regions are given and vcf isn't indexed,
+    a compressed and indexed copy is opened instead. Use records() to iterate over regions.
+    """
+    from cyvcf2 import VCF
+
+    if regions:
+        vcf = compress_and_tabix(vcf)
+    if samples:
+        kwargs["samples"] = samples
+    vcf_in = VCF(vcf, threads=IO_THREADS if IO_THREADS > 1 else None, **kwargs)
+    if samples and len(vcf_in.samples) < len(samples):
+        missing = [s for s in samples if s not in vcf_in.samples]
+        sys.exit("ERROR: samples not found in {}: {}".format(vcf, ", ".join(missing)))
+    return vcf_in
+
+
+def get_regions(region=None, regions_file=None):
+    """Return a list of (chrom, start, end) tuples from the --region and --regions-file arguments
+
+    region is a list of strings like chr1, chr1:1000 or chr1:1,000-2,000 (1-based, inclusive)
+    and regions_file a BED file (0-based). start and end are 0-based and half-open,
+    end is None for a region until the end of the chromosome.
+    """
+    regions = []
+    for r in region or []:
+        chrom, _, coordinates = r.replace(",", "").partition(":")
+        begin, _, end = coordinates.partition("-")
+        regions.append((chrom, int(begin) - 1 if begin else 0, int(end) if end else None))
+    if regions_file:
+        with open(regions_file) as bed:
+            for line in bed:
+                if line.startswith(("#", "track", "browser")) or not line.strip():
+                    continue
+                chrom, start, end = line.split("\t")[:3]
+                regions.append((chrom, int(start), int(end)))
+    return regions
+
+
+def records(vcf, regions=None):
+    """Iterate over the records of a cyvcf2 VCF, only those overlapping regions if given
+
+    Regions are queried using the index, sorted by the order of the contigs in the header
+    and merged when overlapping, so that every record is returned once and in sorted order.
+    """
+    if not regions:
+        yield from vcf
+        return
+    rank = {c: i for i, c in enumerate(vcf.seqnames)}
+    merged = []
+    for chrom, start, end in sorted(
+        regions, key=lambda r: (rank.get(r[0], len(rank)), r[0], r[1])
+    ):
+        last = merged[-1] if merged else None
+        if last and last[0] == chrom and (last[2] is None or start <= last[2]):
+            last[2] = None if None in (last[2], end) else max(last[2], end)
+        else:
+            merged.append([chrom, start, end])
+    previous = None
+    for chrom, start, end in merged:
+        if start == 0 and end is None:
+            query = chrom
+        else:
+            query = "{}:{}-{}".format(chrom, start + 1, end or "")
+        for v in vcf(query):
+            # records spanning two regions were already returned for the previous region
+            if previous and previous[0] == chrom and v.start < previous[2]:
+                continue
+            yield v
+        previous = (chrom, start, end)
+
+
+def open_writer(output, template):
+    """Open a cyvcf2 Writer, bgzip-compressed for .vcf.gz output using IO_THREADS threads
+
+    Compressed output should be indexed with index_vcf after closing the writer.
+    """
+    from cyvcf2 import Writer
+
+    writer = Writer("-" if output in ["stdout", "-"] else output, template)
+    if IO_THREADS > 1:
+        writer.set_threads(IO_THREADS)
+    return writer
+
+
+def is_compressed(vcf):
+    return vcf.endswith((".gz", ".bgz"))
+
+
+def run_tool(command, **kwargs):
+    """Run an external tool, exiting with its error message if it fails"""
+    args = shlex.split(command)
+    with tempfile.TemporaryFile() as stderr:
+        check_tool(args, profiling.call(args, stderr=stderr, **kwargs), stderr)
+
+
+def check_tool(args, returncode, stderr):
+    """Exit with the messages the tool args wrote to the file stderr if it failed"""
+    if returncode != 0:
+        stderr.seek(0)
+        message = stderr.read().decode(errors="replace").strip()
+        sys.exit(f"ERROR: {args[0]} failed (exit {returncode}): {' '.join(args)}\n{message}")
+
+
+def index_vcf(vcf):
+    """Create a tabix index for a compressed vcf, ignoring uncompressed files and stdout"""
+    if is_compressed(vcf):
+        with profiling.stage("tabix"):
+            run_tool("tabix -f -p vcf {}".format(vcf))
+
+
+@contextmanager
+def open_output(output):
+    """Open output to write a vcf as text, which is stdout for "stdout" or "-"
+
+    Output ending in .gz or .bgz is compressed with bgzip using IO_THREADS threads
+    and indexed when closed.
+    """
+    if output in ["stdout", "-"]:
+        yield sys.stdout
+    elif is_compressed(output):
+        args = shlex.split("bgzip -@ {} -c".format(IO_THREADS))
+        with open(output, "wb") as out, tempfile.TemporaryFile() as stderr:
+            bgzip = subprocess.Popen(
+                args, stdin=subprocess.PIPE, stdout=out, stderr=stderr, text=True
+            )
+            try:
+                yield bgzip.stdin
+            finally:
+                try:
+                    bgzip.stdin.close()
+                except BrokenPipeError:  # bgzip failed, reported below
+                    pass
+                check_tool(args, profiling.wait(bgzip), stderr)
+        index_vcf(output)
+    else:
+        with open(output, "w") as out:
+            yield out
 
 
 def is_variant(call):
@@ -17,107 +218,315 @@ def is_variant(call):
         return False
 
 
-def normalize_vcf(vcff):
-    """Normalize a vcf by changing DUP to INS"""
-    import gzip
+def is_variant_array(calls):
+    """Vectorized is_variant, returning a boolean array of the same shape as calls"""
+    return (calls == 1) | (calls == 3)
 
-    handle, name = tempfile.mkstemp(suffix=".vcf")
-    out = open(name, "w")
-    if vcff.endswith(".gz"):
-        vcf = gzip.open(vcff, "rt")
-    else:
-        vcf = open(vcff)
-    for line in vcf:
-        out.write(line.replace("DUP", "INS"))
-    os.close(handle)
+
+GenotypeMatrix = namedtuple(
+    "GenotypeMatrix", ["samples", "chroms", "chrom", "pos", "end", "svtypes", "svtype", "svlen", "gt"]
+)
+
+
+def genotype_matrix(
+    vcf, chunksize=10000, regions=None, samples=None, use_index=True, store_index=False
+):
+    """Read a (merged) vcf once into a GenotypeMatrix of numpy arrays
+
+    samples: list of sample names
+    chroms, svtypes: list of chromosome names and (unparsed) SVTYPE values,
+        indexed by the integer codes in the chrom and svtype arrays
+    pos, end: 0-based start and end coordinate
+    svlen: INFO/SVLEN as float, NaN if absent
+    gt: uint8 matrix of gt_types (records x samples), 0,1,2,3==HOM_REF, HET, UNKNOWN, HOM_ALT
+    Optionally only records in regions (see get_regions) and a list of samples are read.
+    Unless regions are given, a fresh sidecar file written by `surpyvor index` is loaded
+    instead of parsing the vcf, and with store_index the sidecar is written after parsing.
+    """
+    import numpy as np
+
+    if use_index and not regions:
+        from surpyvor import sidecar
+
+        gm = sidecar.load(vcf, samples=samples)
+        if gm is not None:
+            return gm
+    with profiling.stage("genotype_matrix", python=True) as stage:
+        vcffile = vcf
+        vcf = open_vcf(vcf, regions=regions, samples=samples)
+        chroms, svtypes = {}, {}
+        columns = {k: [] for k in ["chrom", "pos", "end", "svtype", "svlen"]}
+        gt_chunks, chunk = [], []
+        for v in records(vcf, regions):
+            svlen = v.INFO.get("SVLEN")
+            if isinstance(svlen, tuple):
+                svlen = svlen[0]
+            columns["chrom"].append(chroms.setdefault(v.CHROM, len(chroms)))
+            columns["pos"].append(v.start)
+            columns["end"].append(v.end)
+            columns["svtype"].append(svtypes.setdefault(v.INFO.get("SVTYPE"), len(svtypes)))
+            columns["svlen"].append(np.nan if svlen is None else svlen)
+            chunk.append(v.gt_types.astype(np.uint8))
+            if len(chunk) == chunksize:
+                gt_chunks.append(np.array(chunk, dtype=np.uint8))
+                chunk = []
+        gt_chunks.append(np.array(chunk, dtype=np.uint8).reshape(len(chunk), len(vcf.samples)))
+        gm = GenotypeMatrix(
+            samples=vcf.samples,
+            chroms=list(chroms),
+            chrom=np.array(columns["chrom"], dtype=np.int32),
+            pos=np.array(columns["pos"], dtype=np.int64),
+            end=np.array(columns["end"], dtype=np.int64),
+            svtypes=list(svtypes),
+            svtype=np.array(columns["svtype"], dtype=np.int16),
+            svlen=np.array(columns["svlen"], dtype=np.float64),
+            gt=np.concatenate(gt_chunks),
+        )
+        stage.records = len(gm.pos)
+    if store_index and not regions and not samples:
+        from surpyvor import sidecar
+
+        sidecar.write(vcffile, gm)
+    return gm
+
+
+DUP_TO_INS = {"DUP": "INS"}
+
+
+def rename_svtype(value, svtype_map):
+    """Rename the type in an SVTYPE or symbolic ALT such as DUP, DUP:TANDEM or <DUP:TANDEM>"""
+    symbolic = value.startswith("<") and value.endswith(">")
+    name = value[1:-1] if symbolic else value
+    svtype, sep, subtype = name.partition(":")
+    if svtype not in svtype_map:
+        return value
+    name = svtype_map[svtype] + sep + subtype
+    return "<{}>".format(name) if symbolic else name
+
+
+def normalize_vcf(vcff, svtype_map=DUP_TO_INS):
+    """Normalize a vcf by renaming SV types (by default DUP to INS), e.g. for SURVIVOR
+
+    Records are streamed with cyvcf2 and only INFO/SVTYPE and symbolic ALT alleles are
+    changed, the output is an uncompressed temporary vcf.
+    The native merge engine renames types while parsing and doesn't need this copy.
+    """
+    from cyvcf2 import Writer
+
+    name = temp_path(suffix=".vcf")
+    with profiling.stage("normalize_vcf", python=True) as stage:
+        vcf = open_vcf(vcff)
+        vcf_out = Writer(name, vcf)
+        for v in profiling.count(vcf, stage):
+            svtype = v.INFO.get("SVTYPE")
+            if svtype is not None and svtype.split(":")[0] in svtype_map:
+                v.INFO["SVTYPE"] = rename_svtype(svtype, svtype_map)
+            if any(alt.startswith("<") for alt in v.ALT):
+                v.ALT = [rename_svtype(alt, svtype_map) for alt in v.ALT]
+            vcf_out.write_record(v)
+        vcf_out.close()
+        vcf.close()
     return name
 
 
-def get_variant_identifiers(vcf, ignore_chroms, num_samples=2):
+def variant_keys(gm):
+    """Return a 64-bit integer key per record of a GenotypeMatrix
+
+    Packs the chromosome code (20 bits), POS (start + 1, 36 bits) and SVTYPE code (8 bits).
+    The start is offset by 1 so that records at POS 0 (start -1) don't wrap around.
+    """
+    import numpy as np
+
+    if len(gm.chroms) > 1 << 20 or len(gm.svtypes) > 1 << 8:
+        sys.exit(
+            f"ERROR: too many chromosomes ({len(gm.chroms)}) or SV types ({len(gm.svtypes)}) "
+            "to compare variants, the maximum is 1048576 and 256."
+        )
+    return (
+        (gm.chrom.astype(np.uint64) << np.uint64(44))
+        | ((gm.pos + 1).astype(np.uint64) << np.uint64(8))
+        | gm.svtype.astype(np.uint64)
+    )
+
+
+def get_variant_identifiers(vcf, ignore_chroms, num_samples=2, rows=None):
     """Get sets of variants for each sample in a merged vcf.
 
-    Loop over the vcf file, adding a unique identifier to the
-    respective list if the sample has a variant for that position
-    return as set
+    vcf is a path or an already parsed GenotypeMatrix.
+    For every sample, return a sorted numpy array with the unique integer keys
+    (see variant_keys) of the records for which the sample has a variant.
+    These support set operations such as np.intersect1d.
+    Optionally, only the records for which the boolean array rows is True are considered.
     """
-    positions = [[] for _ in range(num_samples)]
-    for v in VCF(vcf):
-        if v.CHROM not in ignore_chroms:
-            for index, call in enumerate(v.gt_types):
-                if is_variant(call):
-                    positions[index].append(
-                        "{}:{}-{}".format(v.CHROM, v.start, v.INFO.get("SVTYPE"))
-                    )
-    identifier_sets = [set(i) for i in positions]
-    return identifier_sets
+    import numpy as np
 
+    gm = vcf if isinstance(vcf, GenotypeMatrix) else genotype_matrix(vcf)
+    keep = ~np.isin(gm.chrom, [gm.chroms.index(c) for c in ignore_chroms if c in gm.chroms])
+    if rows is not None:
+        keep &= rows
+    variants = is_variant_array(gm.gt[:, :num_samples]) & keep[:, None]
+    keys = variant_keys(gm)
+    return [np.unique(keys[variants[:, i]]) for i in range(num_samples)]
 
-def gt_types_to_binary_comparison(calls):
-    """From an array of calls, check if a variant position qualifies as a variant.
 
-    0,1,2,3==HOM_REF, HET, UNKNOWN, HOM_ALT
-    Return string of 1s and 0s to represent position"""
-    binary_calls = []
-    for call in calls:
-        if call == 1 or call == 3:
-            binary_calls.append(1)
-        else:
-            binary_calls.append(0)
-    return "".join([str(i) for i in binary_calls])
+LENGTH_BINS = [0, 50, 100, 500, 1000, 5000, 10000, float("inf")]
+
+
+def get_strata(gm):
+    """Return a label per record of a GenotypeMatrix, combining SVTYPE and a bin of SVLEN"""
+    import numpy as np
+
+    edges = np.array(LENGTH_BINS)
+    labels = np.array(
+        [f"{int(lo)}-{int(hi)}" if hi != np.inf else f">={int(lo)}" for lo, hi in zip(edges, edges[1:])]
+        + ["NA"]
+    )
+    svlen = np.abs(gm.svlen)
+    bins = np.where(np.isnan(svlen), len(labels) - 1, np.digitize(svlen, edges[1:-1]))
+    svtypes = np.array([str(t) for t in gm.svtypes])[gm.svtype]
+    return np.char.add(np.char.add(svtypes, ":"), labels[bins])
 
 
-def make_sets(vcf, names):
+def make_sets(vcf, names, max_intersections=None):
     """From the merged SV file, return pd.Series of overlapping sets.
 
+    Every record gets a bit-packed signature of the samples with a variant,
+    and only observed combinations are counted, sorted by decreasing count.
+    If max_intersections is set, only that many of the largest intersections are kept.
+    vcf is a path or an already parsed GenotypeMatrix.
     Intended for making an upset plot"""
-    from collections import defaultdict
+    import numpy as np
+    import pandas as pd
 
-    calls = defaultdict(int)
-    for v in VCF(vcf):
-        calls[gt_types_to_binary_comparison(v.gt_types)] += 1
-    tf_array = [[True, False]] * len(list(calls.keys())[0])
-    index = pd.MultiIndex.from_product(tf_array, names=names)
-    values = [calls["".join([str(int(j)) for j in i])] for i in index]
-    return pd.Series(values, index=index)
+    gm = vcf if isinstance(vcf, GenotypeMatrix) else genotype_matrix(vcf)
+    signatures, counts = np.unique(
+        np.packbits(is_variant_array(gm.gt), axis=1), axis=0, return_counts=True
+    )
+    order = np.argsort(-counts, kind="stable")[:max_intersections]
+    membership = np.unpackbits(signatures[order], axis=1, count=len(gm.samples)).astype(bool)
+    index = pd.MultiIndex.from_arrays(membership.T, names=names)
+    return pd.Series(counts[order], index=index)
+
+
+def write_sets(upsets, output):
+    """Write the observed intersections of make_sets to a tab-separated file"""
+    with open(output, "w") as out:
+        out.write("samples\tcount\n")
+        for membership, count in upsets.items():
+            samples = [n for n, present in zip(upsets.index.names, membership) if present]
+            out.write("{}\t{}\n".format(",".join(samples) or "none", count))
 
 
 def vcf_concat(vcffiles):
-    _, concatenated = tempfile.mkstemp(suffix=".vcf")
-    sample = [get_sample(f) for f in vcffiles][0]
-    vcffiles = [reheader(f, sample=sample) for f in vcffiles]
-    vcffiles = [compress_and_tabix(f) for f in vcffiles]
-    c = subprocess.Popen(
-        shlex.split("bcftools concat -a {}".format(" ".join(vcffiles))),
-        stdout=subprocess.PIPE,
-    )
-    subprocess.call(
-        shlex.split("bcftools sort -o {}".format(concatenated)), stdin=c.stdout
-    )
+    """Combine coordinate-sorted vcf files in a single sorted vcf file
+
+    The records are streamed with a k-way merge, and only the first sample column is kept,
+    using the sample name of the first vcf file.
+    """
+    handle, concatenated = tempfile.mkstemp(suffix=".vcf")
+    sample = get_sample(vcffiles[0])
+    with profiling.stage("vcf_concat", python=True) as stage, os.fdopen(handle, "w") as out:
+        for line in merge_headers(vcffiles, sample=sample):
+            out.write(line + "\n")
+        for v in profiling.count(merge_sorted_vcfs(vcffiles), stage):
+            out.write("\t".join(str(v).rstrip("\n").split("\t")[:10]) + "\n")
     return concatenated
 
 
+def merge_headers(vcffiles, sample):
+    """Return the union of the header lines of vcffiles, with a single sample column
+
+    Structured lines (INFO, FORMAT, contig...) are deduplicated on their ID,
+    keeping the definition of the first file in which they appear.
+    """
+    import re
+    from cyvcf2 import VCF
+
+    structured = re.compile(r"^##([^=]+)=<ID=([^,>]+)")
+    seen = set()
+    header = []
+    for vcffile in vcffiles:
+        for line in VCF(vcffile).raw_header.rstrip("\n").split("\n"):
+            if line.startswith("#CHROM"):
+                continue
+            match = structured.match(line)
+            if match:
+                key = match.groups()
+            elif line.startswith("##fileformat="):
+                key = "fileformat"
+            else:
+                key = line
+            if key not in seen:
+                seen.add(key)
+                header.append(line)
+    header.append("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t{}".format(sample))
+    return header
+
+
+def get_contigs(vcffiles):
+    """Return the union of contigs in the headers of vcffiles, in order of appearance
+
+    Returned is a dict with the contig length, or None if not specified
+    """
+    from cyvcf2 import VCF
+
+    contigs = {}
+    for vcffile in vcffiles:
+        for line in VCF(vcffile).header_iter():
+            if line["HeaderType"] == "CONTIG" and line["ID"] not in contigs:
+                contigs[line["ID"]] = line.info().get("length")
+    return contigs
+
+
+def merge_sorted_vcfs(vcffiles, rank=None, source=False):
+    """Yield the records of coordinate-sorted vcf files in sorted order
+
+    Uses a heap-based k-way merge, so only one record per file is kept in memory.
+    The order of chromosomes is taken from the contig lines in the headers,
+    chromosomes absent from the headers are added in order of appearance.
+    With source, (index of the vcf file, record) tuples are yielded.
+    """
+    import heapq
+
+    if rank is None:
+        rank = {c: i for i, c in enumerate(get_contigs(vcffiles))}
+
+    def keyed_records(index, vcffile):
+        last = (-1, -1)
+        for v in open_vcf(vcffile):
+            key = (rank.setdefault(v.CHROM, len(rank)), v.start)
+            if key < last:
+                sys.exit(
+                    f"ERROR: {vcffile} is not sorted by coordinate or has a different order of "
+                    "chromosomes than the other vcf files.\nSort the file before merging."
+                )
+            last = key
+            yield key, index, v
+
+    keyed = [keyed_records(i, f) for i, f in enumerate(vcffiles)]
+    for _, index, v in heapq.merge(*keyed, key=lambda r: r[0]):
+        yield (index, v) if source else v
+
+
 def get_sample(vcffile):
+    from cyvcf2 import VCF
+
     vcf = VCF(vcffile)
     return vcf.samples[0]
 
 
-def reheader(vcf, sample):
-    _, output = tempfile.mkstemp(suffix=".vcf")
-    handle, samplef = tempfile.mkstemp()
-    open(samplef, "w").write(sample)
-    os.close(handle)
-    subprocess.call(
-        shlex.split("bcftools reheader -s {} {} -o {}".format(samplef, vcf, output))
-    )
-    return output
-
-
 def compress_and_tabix(vcf):
+    """Return a bgzip-compressed and indexed vcf, creating a copy if vcf isn't indexed yet"""
     if vcf.endswith(".vcf"):
-        handle, output = tempfile.mkstemp(suffix=".vcf.gz")
-        subprocess.call(shlex.split("bgzip -c {}".format(vcf)), stdout=handle)
-        subprocess.call(shlex.split("tabix -p vcf {}".format(output)))
+        output = temp_path(suffix=".vcf.gz")
+        with profiling.stage("bgzip"), open(output, "wb") as out:
+            run_tool("bgzip -@ {} -c {}".format(IO_THREADS, vcf), stdout=out)
+        index_vcf(output)
         return output
+    elif is_compressed(vcf) and not any(
+        os.path.isfile(vcf + ext) for ext in [".tbi", ".csi"]
+    ):
+        return compress_and_tabix(decompress(vcf))
     else:
         return vcf
 
@@ -126,18 +535,19 @@ def decompress(vcf):
     """
     Decompress output to temporary file if filename endswith .gz or .bgz
     """
-    if vcf.endswith((".gz", ".bgz")):
-        handle, output = tempfile.mkstemp(suffix=".vcf")
-        subprocess.call(shlex.split("bgzip -cd {}".format(vcf)), stdout=handle)
+    if is_compressed(vcf):
+        output = temp_path(suffix=".vcf")
+        with profiling.stage("bgzip -d"), open(output, "wb") as out:
+            run_tool("bgzip -@ {} -cd {}".format(IO_THREADS, vcf), stdout=out)
         return output
     else:
         return vcf
 
 
-def test_dependencies():
+def test_dependencies(executables=("bcftools", "bgzip", "tabix", "SURVIVOR")):
     from shutil import which
 
-    for dependency in ["bcftools", "bgzip", "tabix", "SURVIVOR"]:
+    for dependency in executables:
         if not which(dependency):
             sys.exit(
                 "ERROR: Could not find required executable '{}'.\n"
@@ -145,34 +555,33 @@ def test_dependencies():
             )
 
 
-def vcf_sort(input, output):
-    if output in ["stdout", "-"]:
-        subprocess.call(shlex.split("bcftools sort {}".format(input)))
-    else:
-        subprocess.call(shlex.split("bcftools sort {} -o {}".format(input, output)))
+def vcf_sort(input, output, max_records=None):
+    """Sort input in-process by the order of the contigs in the header and position
+
+    Input can be a fifo, which is read while being written. At most max_records records
+    are held in memory, the remainder is spilled to temporary files, see sorting.sort_vcf.
+    Output ending in .gz or .bgz is compressed and indexed.
+    """
+    from surpyvor import sorting
+
+    sorting.sort_vcf(input, output, max_records=max_records or sorting.MAX_RECORDS)
 
 
 def confusion_matrix(vcff, names):
     """
-    First level of the dict is the "first" call, second level is the "second" sample
+    Rows are the calls of the "first" sample, columns those of the "second" sample
     0: hom_ref
     1: heterozygous
     2: unknown/nocall
     3: hom_alt
     """
-    zygosities = {
-        0: {0: 0, 1: 0, 2: 0, 3: 0},
-        1: {0: 0, 1: 0, 2: 0, 3: 0},
-        2: {0: 0, 1: 0, 2: 0, 3: 0},
-        3: {0: 0, 1: 0, 2: 0, 3: 0},
-    }
-    for v in VCF(vcff):
-        zygosities[v.gt_types[0]][v.gt_types[1]] += 1
+    import numpy as np
+    import pandas as pd
+
+    gt = genotype_matrix(vcff).gt
+    zygosities = np.bincount(gt[:, 0] * 4 + gt[:, 1], minlength=16).reshape(4, 4)
     zygs = [2, 0, 1, 3]
-    df = pd.DataFrame(index=zygs, columns=zygs)
-    for tr in zygs:
-        for te in zygs:
-            df.loc[tr, te] = zygosities[tr][te]
+    df = pd.DataFrame(zygosities[np.ix_(zygs, zygs)])
     df.columns = ["nocall", "hom_ref", "het", "hom_alt"]
     df.columns.name = names[1]
     df.index = ["nocall", "hom_ref", "het", "hom_alt"]
@@ -180,93 +589,264 @@ def confusion_matrix(vcff, names):
     print(df)
 
 
-def get_svlengths(vcf, all=False):
-    from collections import defaultdict
+class LengthHistogram(object):
+    """Streaming histogram of SV lengths per SV type
+
+    Lengths are counted in bins of <binsize> bp up to <maxlength>, the last bin holding all
+    longer variants. Lengths are buffered per type and added with np.bincount per <chunksize>,
+    so memory use doesn't depend on the number of variants.
+    Also keeps the number of variants and the sum of their lengths per type.
+    """
+
+    def __init__(self, binsize=10, maxlength=20000, chunksize=100000):
+        self.binsize = binsize
+        self.nbins = maxlength // binsize + 1
+        self.chunksize = chunksize
+        self.counts = {}
+        self.number = {}
+        self.total = {}
+        self._pending = {}
+
+    def _new(self, svtype):
+        import numpy as np
+
+        if svtype not in self.counts:
+            self.counts[svtype] = np.zeros(self.nbins, dtype=np.int64)
+            self.number[svtype] = 0
+            self.total[svtype] = 0
+            self._pending[svtype] = []
+
+    def add(self, svtype, length):
+        self._new(svtype)
+        self.number[svtype] += 1
+        self.total[svtype] += length
+        self._pending[svtype].append(length)
+        if len(self._pending[svtype]) >= self.chunksize:
+            self._update(svtype)
+
+    def extend(self, svtype, lengths):
+        """Add a numpy array of integer lengths of svtype at once"""
+        import numpy as np
+
+        self._new(svtype)
+        self.number[svtype] += len(lengths)
+        self.total[svtype] += int(lengths.sum())
+        self.counts[svtype] += np.bincount(
+            np.minimum(lengths // self.binsize, self.nbins - 1), minlength=self.nbins
+        )
+
+    def _update(self, svtype):
+        import numpy as np
+
+        bins = np.array(self._pending[svtype], dtype=np.int64) // self.binsize
+        self.counts[svtype] += np.bincount(
+            np.minimum(bins, self.nbins - 1), minlength=self.nbins
+        )
+        self._pending[svtype] = []
+
+    def histogram(self, svtype, start, stop, binsize):
+        """Return the counts of svtype in bins of binsize (a multiple of self.binsize)
+
+        Returned are the left bin edges and the counts, for lengths from start up to stop
+        """
+        import numpy as np
+
+        if self._pending[svtype]:
+            self._update(svtype)
+        factor = binsize // self.binsize
+        first, last = start // self.binsize, stop // self.binsize
+        counts = self.counts[svtype][first:last].reshape(-1, factor).sum(axis=1)
+        return np.arange(start, stop, binsize), counts
+
 
-    len_dict = defaultdict(list)
-    vcf = VCF(vcf)
+def get_svlengths(vcf, all=False, regions=None, samples=None):
+    """Return a LengthHistogram of the lengths of SVs in vcf, optionally in regions and samples
+
+    Unless regions are given, a fresh sidecar file written by `surpyvor index` is used if possible.
+    """
+    histogram = LengthHistogram()
+    if not regions:
+        from surpyvor import sidecar
+
+        gm = sidecar.load(vcf, samples=samples)
+        if gm is not None and svlengths_from_matrix(gm, histogram, all=all):
+            return histogram
+    vcf = open_vcf(vcf, regions=regions, samples=samples)
     if not all and len(vcf.samples) > 1:
         sys.stderr.write(f"\n\nWarning: only using first sample: {vcf.samples[0]}.\n")
         sys.stderr.write("Use --all to plot all variants.\n")
-    for v in vcf:
+    for v in records(vcf, regions):
         if all or is_variant(v.gt_types[0]) and not v.INFO.get("SVTYPE") == "TRA":
             try:
-                if get_svlen(v) >= 50:
-                    len_dict[get_svtype(v)].append(get_svlen(v))
+                svlen = get_svlen(v)
+                if svlen >= 50:
+                    histogram.add(get_svtype(v), svlen)
             except TypeError:
                 if v.INFO.get("SVTYPE") == "INV":
                     if (v.end - v.start) >= 50:
-                        len_dict[get_svtype(v)].append(v.end - v.start)
+                        histogram.add(get_svtype(v), v.end - v.start)
                 elif v.INFO.get("SVTYPE") == "BND":
                     try:
-                        len_dict["BND"].append(abs(v.INFO.get("MATEDIST")))
+                        histogram.add("BND", abs(v.INFO.get("MATEDIST")))
                     except TypeError:
-                        len_dict["BND"].append(0)
+                        histogram.add("BND", 0)
                 else:
                     sys.stderr.write(
                         "Exception when parsing variant:\n{}\n\n".format(v)
                     )
-                    len_dict["parse_error"].append(0)
-    return len_dict
+                    histogram.add("parse_error", 0)
+    return histogram
+
+
+def svlengths_from_matrix(gm, histogram, all=False):
+    """Add the SV lengths of a GenotypeMatrix to histogram, as get_svlengths does per record
+
+    Returns False without changing histogram if a record lacks SVLEN and isn't an inversion,
+    as these need information from the vcf itself.
+    """
+    import numpy as np
+
+    svtypes = np.array([str(t) for t in gm.svtypes] + ["None"])[gm.svtype]
+    if all:
+        selected = np.ones(len(gm.pos), dtype=bool)
+    else:
+        selected = is_variant_array(gm.gt[:, 0]) & (svtypes != "TRA")
+    missing = np.isnan(gm.svlen)
+    if np.any(selected & missing & (svtypes != "INV")):
+        return False
+    if not all and len(gm.samples) > 1:
+        sys.stderr.write(f"\n\nWarning: only using first sample: {gm.samples[0]}.\n")
+        sys.stderr.write("Use --all to plot all variants.\n")
+    lengths = np.where(missing, gm.end - gm.pos, np.abs(np.nan_to_num(gm.svlen))).astype(np.int64)
+    names = np.array([svtype_name(str(t)) for t in gm.svtypes] + ["None"])[gm.svtype]
+    keep = selected & (lengths >= 50)
+    _, first = np.unique(names[keep], return_index=True)
+    for name in names[keep][np.sort(first)]:
+        histogram.extend(name, lengths[keep & (names == name)])
+    return True
 
 
 def get_svtype(v):
-    if v.INFO.get("SVTYPE") == "INVDUP":
+    return svtype_name(v.INFO.get("SVTYPE"))
+
+
+def svtype_name(svtype):
+    if svtype == "INVDUP":
         return "INV"
     else:
-        return v.INFO.get("SVTYPE").split(":")[0].split("/")[0]
+        return svtype.split(":")[0].split("/")[0]
 
 
 def get_svlen(v):
     return abs(v.INFO.get("SVLEN"))
 
 
-def filter_vcf(vcf, output, minlength=0, truncate_svlen=float("inf"), suffix=""):
-    vcf_in = VCF(vcf)
+def filter_vcf(
+    vcf,
+    output,
+    minlength=0,
+    truncate_svlen=float("inf"),
+    suffix="",
+    regions=None,
+    samples=None,
+    threads=1,
+):
     if not output:
         output = vcf.replace(".vcf", "_{}.vcf".format(suffix))
-    vcf_in.add_info_to_header(
-        {
-            "ID": "TRUNCATED",
-            "Description": "SVLEN truncated",
-            "Type": "Flag",
-            "Number": "0",
-        }
+    counts = transform_vcf(
+        vcf,
+        output,
+        transform=partial(filter_record, minlength=minlength, truncate_svlen=truncate_svlen),
+        add_header=add_fix_header,
+        regions=regions,
+        samples=samples,
+        threads=threads,
     )
-    vcf_out = Writer(output, vcf_in)
-    records_truncated = 0
-    records_filtered = 0
-    for v in vcf_in:
-        svlen = get_svlen(v)
-        if svlen >= minlength:
-            if svlen > truncate_svlen:
-                v.INFO["SVLEN"] = 1
-                v.INFO["END"] = v.start + 1
-                v.INFO["TRUNCATED"] = True
-                records_truncated += 1
-            vcf_out.write_record(v)
-        else:
-            records_filtered += 1
-    if records_truncated != 0:
+    if counts["truncated"] != 0:
         sys.stderr.write(
             "Truncated {} records where SVLEN > {}\n".format(
-                records_truncated, int(truncate_svlen)
+                counts["truncated"], int(truncate_svlen)
             )
         )
-    if records_filtered != 0:
+    if counts["filtered"] != 0:
         sys.stderr.write(
             "Filtered {} records where SVLEN < {}\n".format(
-                records_filtered, int(minlength)
+                counts["filtered"], int(minlength)
             )
         )
 
 
-def fix_vcf(vcf, output, fai, jasmine=False):
-    chromsizes = {line.split()[0]: int(line.split()[1]) for line in open(fai)}
+def filter_record(v, counts, minlength=0, truncate_svlen=float("inf")):
+    svlen = get_svlen(v)
+    if svlen < minlength:
+        counts["filtered"] += 1
+        return None
+    if svlen > truncate_svlen:
+        v.INFO["SVLEN"] = 1
+        v.INFO["END"] = v.start + 1
+        v.INFO["TRUNCATED"] = True
+        counts["truncated"] += 1
+    return v
+
 
-    vcf_in = VCF(vcf)
+def fix_vcf(vcf, output, fai, jasmine=False, regions=None, samples=None, threads=1):
+    with open(fai) as fai_file:
+        chromsizes = {line.split()[0]: int(line.split()[1]) for line in fai_file}
     if not output:
         output = vcf.replace(".vcf", "_{}.vcf".format("fixed"))
+    counts = transform_vcf(
+        vcf,
+        output,
+        transform=partial(fix_record, chromsizes=chromsizes),
+        add_header=partial(add_fix_header, fix=True, jasmine=jasmine),
+        regions=regions,
+        samples=samples,
+        threads=threads,
+        moves_records=True,
+    )
+    if counts["mito"] != 0:
+        sys.stderr.write(f"Removed {counts['mito']} records on chrM.\n")
+    if counts["fixed"] != 0:
+        sys.stderr.write(f"Fixed {counts['fixed']} records.\n")
+    if counts["truncated"] != 0:
+        sys.stderr.write(
+            f"Truncated {counts['truncated']} records where END > chromosome size\n"
+        )
+    if counts["interchromosomal"] != 0:
+        sys.stderr.write(
+            f"Dropped END for {counts['interchromosomal']} interchromosomal BNDs\n"
+        )
+
+
+def fix_record(v, counts, chromsizes):
+    if v.CHROM == "chrM":
+        counts["mito"] += 1
+        return None
+    if v.start == -1:
+        v.set_pos(0)
+        counts["fixed"] += 1
+    try:
+        if (v.INFO.get("SVTYPE") == "BND") and (v.CHROM != v.INFO.get("CHR2")):
+            del v.INFO["END"]
+            counts["interchromosomal"] += 1
+    except KeyError:
+        pass
+    try:
+        if chromsizes[v.INFO.get("CHR2")] < v.INFO.get("END"):
+            v.INFO["SVLEN"] = 1
+            v.INFO["END"] = v.start + 1
+            v.INFO["TRUNCATED"] = True
+            counts["truncated"] += 1
+    except KeyError:
+        pass
+    if v.INFO.get("SVLEN") == 999999999:
+        v.INFO["SVLEN"] = 1
+        v.INFO["TRUNCATED"] = True
+    return v
+
+
+def add_fix_header(vcf_in, fix=False, jasmine=False):
+    """Add the header lines for records changed by filter_record, or fix_record if fix"""
     vcf_in.add_info_to_header(
         {
             "ID": "TRUNCATED",
@@ -275,6 +855,8 @@ def fix_vcf(vcf, output, fai, jasmine=False):
             "Number": "0",
         }
     )
+    if not fix:
+        return
     vcf_in.add_info_to_header(
         {
             "ID": "STRANDS2",
@@ -304,48 +886,104 @@ def fix_vcf(vcf, output, fai, jasmine=False):
         vcf_in.add_info_to_header(
             {"ID": "AF", "Description": "foo", "Type": "Float", "Number": "1"}
         )
-    handle, interm_output = tempfile.mkstemp(suffix=".vcf")
-    vcf_out = Writer(interm_output, vcf_in)
-    records_fixed = 0
-    records_truncated = 0
-    mito_variants = 0
-    interchromosomal_bnds = 0
-    for v in vcf_in:
-        if v.CHROM == "chrM":
-            mito_variants += 1
-            continue
-        if v.start == -1:
-            v.set_pos(0)
-            records_fixed += 1
-        try:
-            if (v.INFO.get("SVTYPE") == "BND") and (v.CHROM != v.INFO.get("CHR2")):
-                del v.INFO["END"]
-                interchromosomal_bnds += 1
-        except KeyError:
-            pass
+
+
+def transform_vcf(
+    vcf,
+    output,
+    transform,
+    add_header=None,
+    regions=None,
+    samples=None,
+    threads=1,
+    moves_records=False,
+):
+    """Write the records of a vcf as changed by transform to output
+
+    transform(v, counts) returns the (changed) record, or None to drop it,
+    and counts changes in the collections.Counter counts, which is returned.
+    add_header(vcf_in) adds the header lines required for the changes.
+    Set moves_records if transform can change the position of records, which then requires
+    a coordinate-sorted vcf, see transform_records.
+    With threads > 1 contigs are transformed in parallel, see parallel.sharded_transform.
+    """
+    name = getattr(transform, "func", transform).__name__
+    if threads > 1:
+        from surpyvor.parallel import sharded_transform
+
+        with profiling.stage(f"{name} ({threads} processes)"):
+            return sharded_transform(
+                vcf,
+                output,
+                transform=transform,
+                add_header=add_header,
+                regions=regions,
+                samples=samples,
+                threads=threads,
+                moves_records=moves_records,
+            )
+    with profiling.stage(name, python=True) as stage:
+        vcf_in = open_vcf(vcf, regions=regions, samples=samples)
+        if add_header:
+            add_header(vcf_in)
+        vcf_out = open_writer(output, vcf_in)
         try:
-            if chromsizes[v.INFO.get("CHR2")] < v.INFO.get("END"):
-                v.INFO["SVLEN"] = 1
-                v.INFO["END"] = v.start + 1
-                v.INFO["TRUNCATED"] = True
-                records_truncated += 1
-        except KeyError:
-            pass
-        if v.INFO.get("SVLEN") == 999999999:
-            v.INFO["SVLEN"] = 1
-            v.INFO["TRUNCATED"] = True
-        vcf_out.write_record(v)
-    vcf_out.close()
-    vcf_sort(interm_output, output)
-    if mito_variants != 0:
-        sys.stderr.write(f"Removed {mito_variants} records on chrM.\n")
-    if records_fixed != 0:
-        sys.stderr.write(f"Fixed {records_fixed} records.\n")
-    if records_truncated != 0:
-        sys.stderr.write(
-            f"Truncated {records_truncated} records where END > chromosome size\n"
-        )
-    if interchromosomal_bnds != 0:
-        sys.stderr.write(
-            f"Dropped END for {interchromosomal_bnds} interchromosomal BNDs\n"
-        )
+            counts = transform_records(
+                profiling.count(records(vcf_in, regions), stage),
+                transform,
+                write=vcf_out.write_record,
+                name=vcf,
+                moves_records=moves_records,
+            )
+        except SystemExit:
+            vcf_out.close()
+            if output not in ["stdout", "-"]:
+                os.remove(output)
+            raise
+        vcf_out.close()
+    index_vcf(output)
+    return counts
+
+
+def transform_records(variants, transform, write, name, moves_records=False):
+    """Apply transform to variants and write the results in input order
+
+    With moves_records the variants have to be sorted, and only records moved downstream by
+    the transform (e.g. set_pos(0) for POS 0) are re-sorted: these are held in a heap until
+    the input reaches their new position.
+    """
+    import heapq
+    from collections import Counter
+
+    counts = Counter()
+    if not moves_records:
+        for v in variants:
+            v = transform(v, counts)
+            if v is not None:
+                write(v)
+        return counts
+    moved = []
+    chrom, last = None, None
+    for index, v in enumerate(variants):
+        if v.CHROM != chrom:
+            while moved:
+                write(heapq.heappop(moved)[2])
+            chrom, last = v.CHROM, v.start
+        if v.start < last:
+            sys.exit(
+                f"ERROR: {name} is not sorted by coordinate.\n"
+                "Sort the file first, e.g. with surpyvor sort."
+            )
+        last = start = v.start
+        v = transform(v, counts)
+        if v is None:
+            continue
+        while moved and moved[0][0] <= start:
+            write(heapq.heappop(moved)[2])
+        if v.start > start:
+            heapq.heappush(moved, (v.start, index, v))
+        else:
+            write(v)
+    while moved:
+        write(heapq.heappop(moved)[2])
+    return counts